@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+import ast
+import inspect
+import json
+import random
+import re
+from os.path import dirname, join
+from tempfile import TemporaryDirectory
+
+from rich import print
+
+import filter
+
+# properties and their layer by the if-chain layer() before it was cached,
+# one JSON [properties, layer] per line
+LAYERS = join(dirname(__file__), "filter-check-layers.json")
+
+
+def feature(i, n):
+    return {
+        "type": "Feature",
+        "geometry": {"type": "LineString", "coordinates": [[i, j] for j in range(n)]},
+        "properties": {"OBJNAM": f"feature {i}", "VALNMR": 1.5},
+    }
+
+
+class CountingFile:
+    "file that counts its read calls"
+
+    def __init__(self, f):
+        self.f = f
+        self.reads = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.f.close()
+
+    def __getattr__(self, a):
+        return getattr(self.f, a)
+
+    def read(self, size=-1):
+        self.reads += 1
+        return self.f.read(size)
+
+
+def check_large_features():
+    "features larger than the read chunk, in both supported layouts"
+    features = [feature(i, n) for i, n in enumerate((1, 2000, 3, 5000))]
+    with TemporaryDirectory() as tmp:
+        fc = f"{tmp}/fc.json"
+        with open(fc, "w") as f:
+            json.dump({"type": "FeatureCollection", "features": features}, f)
+        seq = f"{tmp}/seq.json"
+        with open(seq, "w") as f:
+            f.writelines(f"\x1e{json.dumps(x)}\n" for x in features)
+
+        for filename in (fc, seq):
+            files = []
+
+            def counting_open(*args, **kwargs):
+                files.append(CountingFile(open(*args, **kwargs)))
+                return files[-1]
+
+            filter.open = counting_open
+            try:
+                assert list(filter.read_features(filename, chunk=64)) == features
+            finally:
+                del filter.open
+            # the buffer grows geometrically, not by one chunk per retry
+            assert files[0].reads < 100, files[0].reads
+
+
+def layer_keys():
+    """property names layer_uncached compares, S-57 attributes in both cases
+
+    without catgeo, whose values are drawn separately"""
+    src = inspect.getsource(filter.layer_uncached)
+    names = {
+        n.value
+        for n in ast.walk(ast.parse(src))
+        if isinstance(n, ast.Constant) and isinstance(n.value, str)
+    }
+    skip = {v[1] for v in filter.s57obj.values()} | {"catgeo", "CATGEO"}
+    names = sorted(n for n in names - skip if re.fullmatch(r"[A-Za-z_]\w{3,}", n))
+    attrs = {k for v in filter.s57attr.values() for k in (v[1], v[1].lower())}
+    return names, sorted(attrs - skip)
+
+
+def layer_value(rnd, k):
+    "random value of property k"
+    if k.endswith("_type"):
+        return rnd.choice([None, 1.0, True, "1", *range(20)])
+    if k == "COLOUR":
+        return rnd.choice(
+            ["3", "4", "34", "2,6", "6", 6, 3, 3.0, "1,3", "2,3", 13, None]
+        )
+    if k == "OBJNAM":
+        return rnd.choice(["Radar 1", "RADAR", "x", 5, None])
+    return rnd.choice([1, "x", None])
+
+
+def layer_props(n, seed=1):
+    "random properties, keys independent of the tables layer() caches by"
+    rnd = random.Random(seed)
+    names, attrs = layer_keys()
+    for i in range(n):
+        p = {"catgeo": rnd.choice([0, 1, 2, 3, "1", 2.0])}
+        keys = rnd.sample(names, rnd.randint(0, 4)) + rnd.sample(
+            attrs, rnd.randint(0, 2)
+        )
+        for k in keys:
+            p[k] = layer_value(rnd, k)
+        yield p
+
+
+def check_layer():
+    "layer() classifies the recorded properties like the original if-chain"
+    with open(LAYERS) as f:
+        layers = [json.loads(line) for line in f]
+    filter.layer_cache.clear()
+    for p, layer in layers + layers:  # twice for cache hits
+        assert filter.layer(p) == layer, (p, layer)
+
+
+def check_layer_cache():
+    "cached layer() equals layer_uncached, also with one property less or more"
+    rnd = random.Random(2)
+    names, attrs = layer_keys()
+    filter.layer_cache.clear()
+    for p in layer_props(3000):
+        less = [{k: v for k, v in p.items() if k != d} for d in p]
+        more = [dict(p, **{k: layer_value(rnd, k)}) for k in names if k not in p]
+        for q in [p] + less + more:
+            assert filter.layer(q) == filter.layer_uncached(q), q
+
+
+def main():
+    for name, f in list(globals().items()):
+        if name.startswith("check_"):
+            f()
+            print("[green]OK", name)
+
+
+if __name__ == "__main__":
+    main()
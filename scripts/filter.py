@@ -14,10 +14,14 @@ import json
 import os
 import re
 import sys
-from collections import defaultdict
-from functools import partial
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache, partial
+from itertools import chain, repeat
 from os import makedirs
 from os.path import basename, dirname, exists, splitext
+from tempfile import TemporaryDirectory
 
 from rich.console import Console
 from rich.progress import track
@@ -41,15 +45,171 @@ def save_json(filename, data, **kwargs):
     with open(filename, "w") as f:
         try:
             assert data["type"] == "FeatureCollection"
-            f.write('{"type":"FeatureCollection","features":[\n')
-            n = len(data["features"])
-            for i, e in enumerate(data["features"], 1):
-                f.write(json.dumps(e) + ("," if i < n else "") + "\n")
-            f.write("]}\n")
+            write_features(f, data["features"])
         except:
             return json.dump(data, f, **kwargs)
 
 
+FC_HEAD = '{"type":"FeatureCollection","features":[\n'
+
+
+def write_features(f, features, dumps=json.dumps):
+    "write features to open file f as FeatureCollection, one per line, return count"
+    f.write(FC_HEAD)
+    n = 0
+    for n, e in enumerate(features, 1):
+        f.write((",\n" if n > 1 else "") + dumps(e))
+    f.write("\n]}\n" if n else "]}\n")
+    return n
+
+
+def append_features(filename, seqfile):
+    """append the features of GeoJSONSeq file to a FeatureCollection file
+
+    files written by write_features are extended in place, others rewritten,
+    an interrupted in-place append leaves a truncated file"""
+
+    def lines():
+        with open(seqfile) as f:
+            for l in f:
+                yield l.rstrip("\n")
+
+    if not exists(filename):
+        with open(filename, "w") as f:
+            write_features(f, lines(), str)
+        return
+    with open(filename, "rb+") as f:
+        head = f.read(len(FC_HEAD))
+        end = f.seek(0, 2)
+        start = f.seek(max(0, end - 64))
+        tail = f.read().rstrip()
+        body = tail[:-2].rstrip()
+        if head == FC_HEAD.encode() and tail.endswith(b"]}") and body:
+            empty = body.endswith(b"[")
+            f.seek(start + (len(tail) - 2 if empty else len(body)))
+            f.truncate()
+            f.write(b"" if empty else b",\n")
+            for i, l in enumerate(lines()):
+                f.write(((",\n" if i else "") + l).encode())
+            f.write(b"\n]}\n")
+            return
+    with open(f"{filename}.part", "w") as f:
+        features = chain(read_features(filename), map(json.loads, lines()))
+        write_features(f, features)
+    os.replace(f"{filename}.part", filename)
+
+
+class LayerFiles:
+    """one GeoJSON file per layer (or unmatched.json) in a directory
+
+    features are written to GeoJSONSeq sidecars first, which are appended
+    to the layer files on close, existing layer files are not read again"""
+
+    def __init__(self, ldir, max_open=64):
+        self.ldir = ldir
+        self.max_open = max_open
+        self.files = OrderedDict()  # open sidecars, least recently used first
+        self.counts = Counter()
+
+    def filename(self, l):
+        return f"{self.ldir}/{l or 'unmatched'}.json"
+
+    def write(self, l, feature):
+        f = self.files.get(l)
+        if f:
+            self.files.move_to_end(l)
+        else:
+            if len(self.files) >= self.max_open:
+                self.files.popitem(last=False)[1].close()
+            makedirs(self.ldir, exist_ok=1)
+            # append when reopened after eviction, a sidecar left over from an
+            # aborted run is overwritten, its layer file is not repaired
+            mode = "a" if l in self.counts else "w"
+            f = self.files[l] = open(self.filename(l) + ".seq", mode)
+        f.write(json.dumps(feature) + "\n")
+        self.counts[l] += 1
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+        for l, n in self.counts.items():
+            fn = self.filename(l)
+            if not l:
+                print("unmatched", n)
+            elif exists(fn):
+                print("adding to", l, n)
+            append_features(fn, fn + ".seq")
+            os.remove(fn + ".seq")
+
+
+def read_features(filename, chunk=1 << 20):
+    """yield the features of a GeoJSON file one at a time
+
+    reads FeatureCollections and GeoJSONSeq (one feature per line, optionally
+    RS separated) incrementally, without loading the whole file"""
+    decode = json.JSONDecoder().raw_decode
+    with open(filename) as f:
+        buf, pos = "", 0
+
+        def fill(size=chunk):
+            nonlocal buf, pos
+            data = f.read(size)
+            if data:
+                buf, pos = buf[pos:] + data, 0
+            return bool(data)
+
+        def peek():
+            nonlocal pos
+            while True:
+                while pos < len(buf) and buf[pos] in " \t\r\n\x1e":
+                    pos += 1
+                if pos < len(buf) or not fill():
+                    return buf[pos : pos + 1]
+
+        def value():
+            nonlocal pos
+            peek()
+            while True:
+                try:
+                    v, end = decode(buf, pos)
+                    if end < len(buf) or not fill():  # a number may go on
+                        pos = end
+                        return v
+                except json.JSONDecodeError:
+                    # at least double the buffer, a value larger than chunk
+                    # is decoded again only log(size / chunk) times
+                    if not fill(max(chunk, len(buf) - pos)):
+                        raise
+
+        def expect(c):
+            nonlocal pos
+            if peek() != c:
+                raise ValueError(f"{filename}: expected {c!r} at {f.tell()}")
+            pos += 1
+
+        while peek():
+            expect("{")
+            obj = {}
+            while peek() != "}":
+                key = value()
+                expect(":")
+                if key == "features" and peek() == "[":
+                    expect("[")
+                    while peek() != "]":
+                        yield value()
+                        if peek() == ",":
+                            expect(",")
+                    expect("]")
+                else:
+                    obj[key] = value()
+                if peek() == ",":
+                    expect(",")
+            expect("}")
+            if obj.get("type") == "Feature":
+                yield obj
+
+
 BANDS = {
     "Over": 1,
     "Gene": 2,
@@ -105,13 +265,33 @@ def light_spec(data):
     return " ".join(filter(bool, [ch, co, pe, he, ra]))
 
 
+INT = re.compile(r"[-+]?[0-9]+")
+FLOAT = re.compile(
+    r"[-+]?([0-9]+\.[0-9]*|\.[0-9]+)([eE][-+]?[0-9]+)?|[-+]?[0-9]+[eE][-+]?[0-9]+"
+)
+
+
+@lru_cache(maxsize=1 << 16)
+def number_type(s):
+    "type of number(s) for a string: int, float or str"
+    if INT.fullmatch(s):
+        return int
+    if FLOAT.fullmatch(s):
+        return float
+    for t in [int, float]:  # " 1_000", "nan", non-ASCII digits...
+        try:
+            t(s)
+            return t
+        except:
+            continue
+    return str
+
+
 def number(s):
     if isinstance(s, str):
-        for t in [int, float]:
-            try:
-                return t(s)
-            except:
-                continue
+        t = number_type(s)
+        if t is not str:
+            return t(s)
     return s
 
 
@@ -131,25 +311,198 @@ def parse(s):
 TYPES = None, bool, int, float, list, str
 
 
-def data_types(features):
+def widen(types, k, st):
+    "widen the type of field k to hold values of type st"
+    # only DEPTH is forced to float, VALSOU and ZVALUE are widened as usual
+    if k == "DEPTH":
+        types[k] = float
+    else:
+        types[k] = max(types.get(k), st, key=TYPES.index)
+
+
+def field_types(features):
     types = {}
     for f in features:
         for k, v in f["properties"].items():
-            t = types.get(k)
-            st = type(parse(v))
-            # print(k,v,st,t)
-            if k == "VALSOU":
-                types[k] = float
-            if k == "ZVALUE":
-                types[k] = float
-            if k == "DEPTH":
-                types[k] = float
-            else:
-                types[k] = max(t, st, key=TYPES.index)
-            # print(st,t,types[k])
+            st = number_type(v) if isinstance(v, str) else type(v)
+            if types.get(k) is not st:
+                widen(types, k, st)
+    return types
+
+
+def merge_types(tables):
+    "field types of several inputs, as if typed in one pass"
+    types = {}
+    for t in tables:
+        for k, st in t.items():
+            widen(types, k, st)
+    return types
+
+
+def converters(types):
     return {k: (array if v == list else v) for k, v in types.items()}
 
 
+def data_types(features):
+    return converters(field_types(features))
+
+
+def normalize(f):
+    "clean up properties of a feature read from file"
+    props = f["properties"]  # make upper case keys for 6 char fields
+    props = {k.upper() if len(k) == 6 else k: v for k, v in props.items()}
+    f["properties"] = props
+
+    # list --> string
+    for k in list(props):
+        v = props[k]
+        if isinstance(v, list):
+            props[k] = ",".join(map(str, v))
+
+    # remove empty data values
+    for k, v in dict(props).items():
+        if v is None:
+            del props[k]
+            continue
+        if isinstance(v, str):
+            v = v.strip()
+            if not v:
+                del props[k]
+                continue
+            props[k] = v
+
+    if "LIGHTHOUSES" in props["file"]:
+        props["BCNSHP"] = 3
+
+    light_text = props.get("LIGHTS_TEXT")
+    if light_text:
+        props["OBJNAM"] = (props.get("OBJNAM", "") + " " + light_text).strip()
+    return f
+
+
+def process(f, dtypes, args):
+    "convert, classify and annotate a normalized feature"
+    if "geometry" not in f:
+        return f
+    if "coordinates" not in f["geometry"]:
+        return f
+    if "properties" not in f:
+        return f
+
+    props = f["properties"]
+
+    # convert values to determined types
+    for k, v in props.items():
+        t = dtypes[k]
+        if type(v) is not t:
+            props[k] = t(v)
+
+    # add usage bands
+    if "id" in f:
+        b = band(f["id"])
+        if b:
+            props["uband"] = b
+
+    if "chart" not in props:
+        chart = props.get("dsnm", props.get("name"))
+        if chart:
+            chart = chart.replace(".000", "")
+            props["chart"] = chart
+
+            if args.bsh:
+                meta = CATALOG.get(chart)
+                if meta:
+                    props["scale"] = int(meta["c_scale"])
+
+    # print(ifile,props.get('chart'),props.get('uband'),props.get('lnam'))
+
+    # if 'LITCHR' in props:
+    #   props['light']=light_spec(props)
+
+    # props.update(resolve(props,'_'))
+    # if 'litchr' in props: print(props['light_'])
+
+    # for k in ['COLOUR']:
+    #   v=props.get(k)
+    #   if v:
+    #     res=resolve({k:v},'_')
+    #     if res:
+    #       res[k+'__']=''.join(c[0] for c in res[k+'_'].split('_')).upper()
+    #       props.update(res)
+
+    depth = props.get("ZVALUE", props.get("DEPTH", props.get("depth")))
+    if depth is not None:
+        props["VALSOU"] = depth
+        if props.get("chart") == "1500000":
+            props["uband"] = scale2band(props.get("SCAMIN"))
+            del props["chart"]
+            del props["depth"]
+
+    cols = props.get("COLOUR")
+    if cols:
+        try:
+            props["color"] = "".join(map(abbr_color, map(int, str(cols).split(","))))
+        except:
+            pass
+
+    if "catgeo" not in props:
+        g = f["geometry"]["type"]
+        props["catgeo"] = (
+            1 if "Point" in g else 2 if "Line" in g else 3 if "Polygon" in g else 0
+        )
+
+    if "layer" not in props:
+        l = layer(props)
+        # print('layer',l)
+        if l:
+            props["layer"] = l
+        else:
+            name = splitext(basename(props["file"]))[0]
+            l = name.split("_")[0]
+            if len(l) == 6:
+                props["layer"] = l.upper()
+
+    if args.uband:
+        props["uband"] = args.uband
+    if args.chart:
+        props["chart"] = args.chart
+    if args.layer:
+        props["layer"] = args.layer
+    return f
+
+
+def read_file(fi):
+    "normalized features of an input file"
+    for f in read_features(fi):
+        f["properties"]["file"] = fi
+        yield normalize(f)
+
+
+def file_types(fi):
+    return field_types(read_file(fi))
+
+
+def current_charts(features):
+    "remove old and HD charts - https://linchart60.bsh.de/chartserver/katalog.xml"
+    return (
+        f
+        for f in features
+        if re.match(r"DE\d(NO|OS)...", f["properties"].get("chart", "DE2NO000"))
+    )
+
+
+def filter_file(fi, part, dtypes, args):
+    "process the features of an input file into a GeoJSONSeq part file"
+    features = (process(f, dtypes, args) for f in read_file(fi))
+    if args.bsh:
+        features = current_charts(features)
+    with open(part, "w") as f:
+        for feature in features:
+            f.write(json.dumps(feature))
+            f.write("\n")
+    return part
+
+
 def main():
     parser = ArgumentParser(
         description="BSH WMS data filter", formatter_class=ArgumentDefaultsHelpFormatter
@@ -161,6 +514,13 @@ def main():
     parser.add_argument("-c", "--chart", help="override chart")
     parser.add_argument("-l", "--layer", help="override layer")
     parser.add_argument("--bsh", help="filter BSH charts", action="store_true")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        help="number of processes working on input files, 0: one per core",
+        type=int,
+        default=1,
+    )
     args = parser.parse_args()
 
     ifiles = args.input
@@ -168,15 +528,8 @@ def main():
     ldir = args.layers
     assert ofile or ldir
 
-    features = []
-    for fi in ifiles:
-        data = load_json(fi)
-        fs = data["features"]
-        for f in fs:
-            f["properties"]["file"] = fi
-        features = features + fs
-
-    print(f"[yellow]processing[/] {len(features)} features")
+    def read_inputs():
+        return chain.from_iterable(map(read_file, ifiles))
 
     # add lights
     # for f in features:
@@ -207,168 +560,55 @@ def main():
     #     print(lit)
     #     # features.append({'type':'Feature','properties':lit,'geometry':f['geometry']})
 
-    for f in features:
-        props = f["properties"]  # make upper case keys for 6 char fields
-        props = {k.upper() if len(k) == 6 else k: v for k, v in props.items()}
-        f["properties"] = props
-
-        # list --> string
-        for k in list(props):
-            v = props[k]
-            if isinstance(v, list):
-                props[k] = ",".join(map(str, v))
-
-        # remove empty data values
-        for k, v in dict(props).items():
-            if v is None:
-                del props[k]
-                continue
-            if isinstance(v, str):
-                v = v.strip()
-                if not v:
-                    del props[k]
-                    continue
-                props[k] = v
-
-        if "LIGHTHOUSES" in props["file"]:
-            props["BCNSHP"] = 3
-
-        light_text = props.get("LIGHTS_TEXT")
-        if light_text:
-            props["OBJNAM"] = (props.get("OBJNAM", "") + " " + light_text).strip()
-
-    # determine type of each field
-    dtypes = data_types(features)
-    # for k,v in dtypes.items(): print(k,v)
-
-    for f in track(features, "[green]filtering[/]"):
-        if "geometry" not in f:
-            continue
-        if "coordinates" not in f["geometry"]:
-            continue
-        if "properties" not in f:
-            continue
+    # jobs=1: no process pool
+    pool = ProcessPoolExecutor(args.jobs or None) if args.jobs != 1 else nullcontext()
+    with pool as pool, TemporaryDirectory() as tmp:
+        if pool:
+            # files are typed and processed in parallel, types are merged
+            # before processing and parts are read back in input order
+            tables = pool.map(file_types, ifiles)
+            tables = track(tables, "[yellow]typing[/]", total=len(ifiles))
+            dtypes = converters(merge_types(tables))
+            parts = [f"{tmp}/{i}.json.seq" for i in range(len(ifiles))]
+            parts = pool.map(filter_file, ifiles, parts, repeat(dtypes), repeat(args))
+            features = chain.from_iterable(map(read_features, parts))
+            features = track(features, "[green]filtering[/]")
+        else:
+            # determine type of each field, first pass over all files
+            dtypes = data_types(track(read_inputs(), "[yellow]typing[/]"))
+            # for k,v in dtypes.items(): print(k,v)
 
-        props = f["properties"]
-
-        # convert values to determined types
-        props = {k: dtypes[k](v) for k, v in props.items()}
-        f["properties"] = props
-
-        # add usage bands
-        if "id" in f:
-            b = band(f["id"])
-            if b:
-                props["uband"] = b
-
-        if "chart" not in props:
-            chart = props.get("dsnm", props.get("name"))
-            if chart:
-                chart = chart.replace(".000", "")
-                props["chart"] = chart
-
-                if args.bsh:
-                    meta = CATALOG.get(chart)
-                    if meta:
-                        props["scale"] = int(meta["c_scale"])
-
-        # print(ifile,props.get('chart'),props.get('uband'),props.get('lnam'))
-
-        # if 'LITCHR' in props:
-        #   props['light']=light_spec(props)
-
-        # props.update(resolve(props,'_'))
-        # if 'litchr' in props: print(props['light_'])
-
-        # for k in ['COLOUR']:
-        #   v=props.get(k)
-        #   if v:
-        #     res=resolve({k:v},'_')
-        #     if res:
-        #       res[k+'__']=''.join(c[0] for c in res[k+'_'].split('_')).upper()
-        #       props.update(res)
-
-        depth = props.get("ZVALUE", props.get("DEPTH", props.get("depth")))
-        if depth is not None:
-            props["VALSOU"] = depth
-            if props.get("chart") == "1500000":
-                props["uband"] = scale2band(props.get("SCAMIN"))
-                del props["chart"]
-                del props["depth"]
-
-        cols = props.get("COLOUR")
-        if cols:
-            try:
-                props["color"] = "".join(
-                    map(abbr_color, map(int, str(cols).split(",")))
-                )
-            except:
-                pass
+            # second pass, process and write features one at a time
+            features = (process(f, dtypes, args) for f in read_inputs())
+            features = track(features, "[green]filtering[/]")
 
-        if "catgeo" not in props:
-            g = f["geometry"]["type"]
-            props["catgeo"] = (
-                1 if "Point" in g else 2 if "Line" in g else 3 if "Polygon" in g else 0
-            )
+            if args.bsh:
+                features = current_charts(features)
 
-        if "layer" not in props:
-            l = layer(props)
-            # print('layer',l)
-            if l:
-                props["layer"] = l
-            else:
-                name = splitext(basename(props["file"]))[0]
-                l = name.split("_")[0]
-                if len(l) == 6:
-                    props["layer"] = l.upper()
-
-        if args.uband:
-            props["uband"] = args.uband
-        if args.chart:
-            props["chart"] = args.chart
-        if args.layer:
-            props["layer"] = args.layer
-
-    # remove old and HD charts - https://linchart60.bsh.de/chartserver/katalog.xml
-    # features=data['features']=[f for f in features if re.match(r'DE\d(NO|OS)...',f['properties'].get('chart','DE0NOxxx'))]
-    if args.bsh:
-        features = data["features"] = [
-            f
-            for f in features
-            if re.match(r"DE\d(NO|OS)...", f["properties"].get("chart", "DE2NO000"))
-        ]
-        assert features
-
-    if ofile:
-        print("writing to", ofile)
-        save_json(ofile, data)
-
-    # save layer, one file per layer
-    if not ldir:
-        return
-    print("writing layers to", ldir)
-    layers = set(filter(lambda x: x, (f["properties"].get("layer") for f in features)))
-    for l in layers:
-        fn = f"{ldir}/{l}.json"
-        if exists(fn):  # append to existing data
-            fs0 = load_json(fn)["features"]
-        else:
-            fs0 = []
-        filt = lambda f: f["properties"].get("layer") == l
-        fs1 = list(filter(filt, features))
-        if fs0:
-            print("adding to", l, len(fs1))
-        save_json(fn, {"type": "FeatureCollection", "features": fs0 + fs1})
-
-    unmatched = list(filter(lambda f: "layer" not in f["properties"], features))
-    if unmatched:
-        print("unmatched", len(unmatched))
-        fn = f"{ldir}/unmatched.json"
-        if exists(fn):  # append to existing data
-            um0 = load_json(fn)["features"]
+        # features go to one file per layer as they are processed
+        layers = LayerFiles(ldir) if ldir else None
+
+        def classified(features):
+            for f in features:
+                if layers:
+                    layers.write(f["properties"].get("layer"), f)
+                yield f
+
+        features = classified(features)
+
+        if ofile:
+            print("writing to", ofile)
+            makedirs(dirname(ofile) or ".", exist_ok=1)
+            with open(ofile, "w") as f:
+                n = write_features(f, features)
         else:
-            um0 = []
-        save_json(fn, {"type": "FeatureCollection", "features": um0 + unmatched})
+            n = sum(1 for f in features)
+    print(f"[yellow]processed[/] {n} features")
+    assert n or not args.bsh
+
+    if layers:
+        print("writing layers to", ldir)
+        layers.close()
 
     return
     values = group_keys(features, 1)
@@ -431,7 +671,72 @@ UNIQUE_ATTRS = unique_attributes()
 # for i in UNIQUE_ATTRS.items(): print(i)
 
 
+def unique_layers():
+    "catgeo: {attribute (upper and lower case): (rank, layer)}, lowest rank wins"
+    index = defaultdict(dict)
+    for rank, (a, ls) in enumerate(UNIQUE_ATTRS.items()):
+        for g, l in ls.items():
+            for k in (a.upper(), a.lower()):
+                index[g].setdefault(k, (rank, l))
+    return dict(index)
+
+
+UNIQUE_LAYERS = unique_layers()
+
+# properties layer_uncached looks at: by presence and by value
+LAYER_KEYS = frozenset(k for d in UNIQUE_LAYERS.values() for k in d).union(
+    ["BCNSHP", "BOYSHP", "CATACH", "CATBRG", "CATCAM", "CATCBL", "CATCRN"],
+    ["CATLAM", "CATPIP", "CATREA", "CATSPM", "CATTSS", "CATWED", "DRVAL1"],
+    ["DRVAL2", "ELEVAT", "FUNCTN", "MARSYS", "NATSUR", "RYRMGV", "TOPSHP"],
+    ["TRAFIC", "VALACM", "VALDCO", "VALMAG", "VALSOU", "COLOUR", "OBJNAM"],
+)
+LAYER_VALUES = (
+    "COLOUR",
+    "beacon_type",
+    "berth_type",
+    "caution_type",
+    "coast_type",
+    "depth_type",
+    "dock_type",
+    "facility_type",
+    "land_type",
+    "light_type",
+    "mark_type",
+    "meta_type",
+    "signal_type",
+    "trans_type",
+    "util_type",
+    "zone_type",
+)
+
+layer_cache = {}  # properties signature: layer
+layer_cache_size = 1 << 16
+
+
 def layer(props):
+    "S-57 layer of BSH feature properties, cached by the properties that matter"
+    g = int(props.get("catgeo", 0))
+    name = str(props.get("OBJNAM", ""))
+    try:
+        key = (
+            g,
+            LAYER_KEYS.intersection(props),
+            tuple((type(v), v) for v in map(props.get, LAYER_VALUES)),
+            "Radar" in name,
+            "RADAR" in name,
+        )
+        return layer_cache[key]
+    except KeyError:
+        pass
+    except TypeError:  # unhashable values
+        return layer_uncached(props)
+    if len(layer_cache) >= layer_cache_size:
+        layer_cache.clear()
+    l = layer_cache[key] = layer_uncached(props)
+    return l
+
+
+def layer_uncached(props):
     g = int(props.get("catgeo", 0))
     point, line, area = g == 1, g == 2, g == 3
 
@@ -442,10 +747,11 @@ def layer(props):
     if props.get("util_type") == 2 and line:
         return "CBLSUB"
 
-    for a, ls in UNIQUE_ATTRS.items():
-        if a.upper() in props or a.lower() in props:
-            if g in ls:
-                return ls[g]
+    unique = UNIQUE_LAYERS.get(g)
+    if unique:
+        found = [unique[k] for k in props if k in unique]
+        if found:
+            return min(found)[1]
 
     if "TOPSHP" in props and point and props.get("light_type") == 1:
         return "DAYMAR"
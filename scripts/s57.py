@@ -2,6 +2,7 @@
 
 import re
 from collections import OrderedDict
+from functools import lru_cache
 from itertools import groupby
 
 COLOURS_SHORT = {
@@ -786,14 +787,44 @@ def is_primary(l):
 layers1 = tuple(l for l in S57types.keys() if is_primary(l))
 layers2 = tuple(l for l in S57types.keys() if not is_primary(l))
 
-bb_types = set(
-    k
-    for k in S57keys.values()
-    if "{typ}" in k and any(k.startswith(s) for s in ("buoy", "beacon"))
-)
+# seamark:{typ}:* keys, to be cleared when a buoy or beacon changes its type
+bb_types = set(k for k in S57keys.values() if k.startswith("seamark:{typ}:"))
 
 
 def s57attr(attr, value):
+    "decode S-57 attribute value (or attr of a properties dict) to OSM value"
+    if isinstance(value, dict):
+        return s57attr_uncached(attr, value)
+    a = attr.upper()
+    if a in S57 and S57[a] is None:
+        return cleanup(value)  # plain text or number, not worth caching
+    if type(value) in (str, int):
+        return s57decode(attr, value)
+    return s57attr_uncached(attr, value)
+
+
+def s57code(value):
+    "int code of a raw enum value, None if it is not a plain number"
+    if type(value) is int:
+        return value
+    value = value.strip()
+    if value.isdigit() and value.isascii() and len(value) < 16:
+        return int(value)
+
+
+@lru_cache(maxsize=1 << 14, typed=True)
+def s57decode(attr, value):
+    "s57attr for str and int values, enum lists without exceptions, rest as before"
+    m = S57.get(attr.upper())
+    if isinstance(m, dict):
+        codes = value.split(",") if type(value) is str else [value]
+        names = [m.get(c) for c in map(s57code, codes)]
+        if all(type(n) is str for n in names):
+            return ";".join(names)
+    return s57attr_uncached(attr, value)
+
+
+def s57attr_uncached(attr, value):
     try:
         a = attr.upper()
         if isinstance(value, dict):
@@ -814,10 +845,15 @@ def s57attr(attr, value):
 
 
 def cleanup(s):
-    try:
+    if type(s) is str:
         s = s.strip()
-    except:
-        pass
+        if s.isdigit() and s.isascii() and len(s) < 16:
+            return str(int(s))
+    else:
+        try:
+            s = s.strip()
+        except:
+            pass
     try:
         v = float(s.replace(",", "."))
         return str(int(v) if int(v) == v else v)
@@ -837,8 +873,65 @@ def is_something(props):
     return bool(keys)
 
 
+# attribute: type, for attributes that belong to one type only
+S57typekeys = {
+    k: v.split(":")[1]
+    for k, v in S57keys.items()
+    if v.count(":") == 2 and v.split(":")[1] != "{typ}"
+}
+
+
+def weed_type(props, keys):
+    return "seagrass" if "grass" in s57attr("catwed", props) else "weed"
+
+
+def buoy_beacon_type(props, keys):
+    bb = "buoy" if "boyshp" in keys or "buoy_type" in keys else "beacon"
+    if "catlam" in keys:
+        return bb + "_lateral"
+    if "catcam" in keys:
+        return bb + "_cardinal"
+    if "catspm" in keys:
+        return bb + "_special_purpose"
+    # otherwise decide by color
+    col = s57attr("colour", props) if "colour" in keys else ""
+    pat = s57attr("colpat", props) if "colpat" in keys else ""
+    if "yellow" in col and "black" in col:
+        return bb + "_cardinal"
+    if "yellow" in col or "grey" in col:
+        return bb + "_special_purpose"
+    if "black" in col and "red" in col:
+        return bb + "_isolated_danger"
+    if "white" in col and "red" in col and pat == "vertical":
+        return bb + "_safe_water"
+    if "green" in col or "red" in col:
+        return bb + "_lateral"
+    if bb == "beacon":
+        return bb + "_special_purpose"
+
+
+# (attributes, value, type), first match wins, a type function may return None
+S57typerules = tuple(
+    (frozenset(keys), value, typ)
+    for keys, value, typ in (
+        (["catsil"], None, "tank"),
+        (["catpil"], None, "pilot_boarding"),
+        (["comcha", "calsgn"], None, "radio_station"),
+        (["buishp"], None, "building"),
+        (["catwed"], None, weed_type),
+        (["litchr", "litvis", "catlit", "light_type"], None, "light"),
+        (["boyshp", "buoy_type", "bcnshp", "beacon_type"], None, buoy_beacon_type),
+        (["signal_type"], 5, "radar_transponder"),
+        (["facility_type"], 11, "platform"),
+        (["functn"], None, "building"),
+        (["facility_type"], 1, "building"),
+        (["facility_type"], 4, "crane"),
+        (["signal_type"], 2, "radio_station"),
+    )
+)
+
+
 def s57type(props):
-    props = {k: v for k, v in props.items() if v is not None}
     _type_ = props.get("_type_")
     if _type_:
         return _type_
@@ -846,63 +939,22 @@ def s57type(props):
     #     return "rock"
     # if "obstruction_type" in props:
     #     return "obstruction"
-    if "catobs" in props:
+    if props.get("catobs") is not None:
         return "obstruction"
-    types = set(
-        v.split(":")[1] for k, v in S57keys.items() if v.count(":") == 2 and k in props
-    ).difference(["{typ}"])
+    keys = {k for k, v in props.items() if v is not None}
+    types = {S57typekeys[k] for k in keys.intersection(S57typekeys)}
     if len(types) == 1:
-        return list(types)[0]
-
-    if "catsil" in props:
-        return "tank"
-    if "catpil" in props:
-        return "pilot_boarding"
-    if "comcha" in props:
-        return "radio_station"
-    if "calsgn" in props:
-        return "radio_station"
-    if "buishp" in props:
-        return "building"
-    if "catwed" in props:
-        v = s57attr("catwed", props)
-        return "seagrass" if "grass" in v else "weed"
-    if any(k in props for k in ("litchr", "litvis", "catlit", "light_type")):
-        return "light"
-    if any(k in props for k in ("boyshp", "buoy_type", "bcnshp", "beacon_type")):
-        bb = "buoy" if "boyshp" in props or "buoy_type" in props else "beacon"
-        if "catlam" in props:
-            return bb + "_lateral"
-        if "catcam" in props:
-            return bb + "_cardinal"
-        if "catspm" in props:
-            return bb + "_special_purpose"
-        # otherwise decide by color
-        col = s57attr("colour", props) if "colour" in props else ""
-        pat = s57attr("colpat", props) if "colpat" in props else ""
-        if "yellow" in col and "black" in col:
-            return bb + "_cardinal"
-        if "yellow" in col or "grey" in col:
-            return bb + "_special_purpose"
-        if "black" in col and "red" in col:
-            return bb + "_isolated_danger"
-        if "white" in col and "red" in col and pat == "vertical":
-            return bb + "_safe_water"
-        if "green" in col or "red" in col:
-            return bb + "_lateral"
-        if bb == "beacon":
-            return bb + "_special_purpose"
-    if props.get("signal_type") == 5:
-        return "radar_transponder"
-    if props.get("facility_type") == 11:
-        return "platform"
-    if "functn" in props or props.get("facility_type") == 1:
-        return "building"
-    if props.get("facility_type") == 4:
-        return "crane"
-    if props.get("signal_type") == 2:
-        return "radio_station"
-    assert 0, (types, props)
+        return types.pop()
+
+    for attrs, value, typ in S57typerules:
+        if attrs.isdisjoint(keys):
+            continue
+        if value is not None and props[next(iter(attrs))] != value:
+            continue
+        typ = typ(props, keys) if callable(typ) else typ
+        if typ:
+            return typ
+    assert 0, (types, {k: v for k, v in props.items() if v is not None})
 
 
 def s57cat(props):
@@ -947,7 +999,63 @@ def s57cat(props):
                     return "port"
 
 
+# properties that are translated one to one, patched into cached tag templates
+S57varying = "objnam", "lnam"
+
+# properties that s57translate looks at, besides the varying ones
+S57translated = (
+    set(S57keys)
+    .union(*(keys for keys, value, typ in S57typerules))
+    .union(["_type_"])
+    .difference(S57varying)
+)
+
+translate_cache = {}  # properties signature: tags, set to None to disable
+translate_cache_size = 1 << 14
+translate_stats = {"hits": 0, "misses": 0}
+
+
+def translate_cache_info():
+    return dict(translate_stats, size=len(translate_cache or ()))
+
+
 def s57translate(props):
+    if translate_cache is None:
+        return s57translate_uncached(props)
+    try:
+        key = frozenset(
+            (k, type(v), repr(v) if type(v) is float else v)  # -0.0 != 0.0
+            for k, v in props.items()
+            if k in S57translated and v is not None
+        )
+        template = translate_cache.get(key)
+    except TypeError:  # unhashable values
+        return s57translate_uncached(props)
+
+    if template is None:
+        translate_stats["misses"] += 1
+        try:
+            p = {k: v for k, v in props.items() if k not in S57varying}
+            template = s57translate_uncached(p)
+        except:
+            return s57translate_uncached(props)
+        if len(translate_cache) >= translate_cache_size:
+            translate_cache.clear()
+        translate_cache[key] = template
+    else:
+        translate_stats["hits"] += 1
+
+    items = iter(template.items())
+    tags = dict([next(items)])  # seamark:type
+    for k in S57varying:
+        v = props.get(k)
+        if v:
+            tags[S57keys[k]] = s57attr(k, v)
+    tags.update(items)
+    return tags
+
+
+def s57translate_uncached(props):
     props = {k: v for k, v in props.items() if v is not None}
     typ = s57type(props)
     tags = {"seamark:type": typ}
@@ -982,15 +1090,21 @@ def add_tags(tags, props):
     return tags
 
 
-def fill_types(tags):
-    typ = smtype(tags)
-    for t in S57types.values():
-        if t == typ:
-            continue
-        for k in bb_types:
-            k = k.format(typ=t)
-            if k not in tags:
-                tags[k] = None
+# type: tags of all other buoy/beacon types, to be removed from a node of that type
+S57clear = {
+    typ: frozenset(
+        k.format(typ=t)
+        for t in S57types.values()
+        if t != typ and t.startswith(("buoy", "beacon"))
+        for k in bb_types
+    )
+    for typ in list(S57types.values()) + [None]
+}
+
+
+def clear_keys(tags):
+    "keys of other types that must not remain on a node with these tags"
+    return S57clear.get(smtype(tags), S57clear[None])
 
 
 def add_generic_topmark(tags):
@@ -1190,12 +1304,16 @@ def merge_lights(lights):
         return merged
 
 
-def group_by(data, key=lambda v: v):
+def group_by(data, key=lambda v: v, indices=False):
+    "group data by key, in order of appearance, lists of indices into data if indices"
     # return dict(groupby(data, key))
     grp = OrderedDict()
-    for e in data:
-        k = key(e)
-        grp[k] = grp.get(k, []) + [e]
+    if indices:
+        for i, e in enumerate(data):
+            grp.setdefault(key(e), []).append(i)
+    else:
+        for e in data:
+            grp.setdefault(key(e), []).append(e)
     return grp
 
 
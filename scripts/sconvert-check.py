@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+from rich import print
+
+import sconvert
+
+
+def check_layer_codes():
+    "standard classes for upper case acronyms, inland classes share them"
+    assert sconvert.layer_codes(["DEPARE", "BOYLAT"]) == {42, 17}
+    assert sconvert.layer_codes(["depare", "soundg"]) == {17003, 129}
+    try:
+        sconvert.layer_codes(["DEPARE", "FOO", "COLOUR"])
+    except ValueError as e:
+        assert str(e) == "unknown layers: FOO COLOUR", e
+    else:
+        raise AssertionError("unknown layers accepted")
+
+
+def main():
+    for name, f in list(globals().items()):
+        if name.startswith("check_"):
+            f()
+            print("[green]OK", name)
+
+
+if __name__ == "__main__":
+    main()
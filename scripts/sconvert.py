@@ -14,7 +14,7 @@ try:
 except:
     pass
 from collections import defaultdict
-from itertools import accumulate
+from itertools import accumulate, chain
 from os import makedirs
 from os.path import basename, dirname, join, splitext
 
@@ -29,6 +29,7 @@ if __name__ == "__main__":
         print = console.print
         track = partial(track, console=console)
 
+import numpy as np  # required by senc as well
 from geojson import (
     Feature,
     FeatureCollection,
@@ -42,7 +43,6 @@ from geojson import (
 
 try:
     import mapbox_earcut as earcut
-    import numpy as np
     import shapely
 except:
     pass
@@ -57,6 +57,7 @@ from senc import (
     FEATURE_GEOMETRY_RECORD_MULTIPOINT,
     FEATURE_GEOMETRY_RECORD_POINT,
     FEATURE_ID_RECORD,
+    FEATURE_RECORD_TYPES,
     HEADER_CELL_EDITION,
     HEADER_CELL_NAME,
     HEADER_CELL_NATIVESCALE,
@@ -67,6 +68,7 @@ from senc import (
     HEADER_CELL_UPDATEDATE,
     S57_RECORD_TYPES,
     SENC,
+    TABLE_RECORD_TYPES,
     VECTOR_CONNECTED_NODE_TABLE_RECORD,
     VECTOR_EDGE_NODE_TABLE_RECORD,
     grid2ll,
@@ -138,6 +140,23 @@ def acronym_code(name):
             return k
 
 
+def layer_codes(layers):
+    """object class codes of layer acronyms, ValueError for unknown ones
+
+    inland classes (17000+) reuse standard acronyms in lower case, an exact
+    match wins, otherwise the first class of that acronym in any case"""
+    codes = {}
+    for k, v in s57obj.items():
+        if isinstance(k, int):
+            codes.setdefault(v[1], k)
+            codes.setdefault(v[1].upper(), k)
+    codes = {l: codes.get(l, codes.get(l.upper())) for l in layers}
+    unknown = [l for l, c in codes.items() if c is None]
+    if unknown:
+        raise ValueError(f"unknown layers: {' '.join(unknown)}")
+    return set(codes.values())
+
+
 def get_uband(chart):
     if chart.startswith("OC"):
         return int(chart[-1])
@@ -150,149 +169,160 @@ def get_uband(chart):
 CHART = "chart"
 
 
-def senc2features(filename, txtdir=None, multipoints=False):
-    "convert SENC records to GeoJSON features"
-    recs = SENC(filename).records()
+def senc2features(filename, txtdir=None, multipoints=False, layers=None):
+    "convert SENC records to GeoJSON features, optionally of some layers only"
+    ftypes = layers and layer_codes(layers)
+    with SENC(filename) as senc:
+        types, index = senc.index()
 
-    features = []
-    node_table, edge_table = {}, {}
+        # cell header and tables first, features are read one at a time
+        skip = {FEATURE_ID_RECORD, *FEATURE_RECORD_TYPES}
+        if ftypes and not any(p for (t, i, p), _ in index if t in ftypes):
+            skip |= set(TABLE_RECORD_TYPES)  # points only, no node/edge tables
+        offsets = sorted(o for t in types if t not in skip for o in types[t])
+        recs = map(senc.record, offsets)
 
-    chart = splitext(basename(filename))[0]
-    uband = get_uband(chart)
+        features = []
+        node_table, edge_table = {}, {}
 
-    for r in recs:  # first pass
-        if r["name"] == "cell_native_scale":
-            scale = r["scale"]
-            continue
+        chart = splitext(basename(filename))[0]
+        uband = get_uband(chart)
 
-        if r["name"] == "cell_name":
-            chart = r["cellname"] or chart
-            uband = get_uband(chart)
-            continue
+        for r in recs:  # first pass
+            if r["name"] == "cell_native_scale":
+                scale = r["scale"]
+                continue
 
-        if r["name"] == "cell_extent":
-            cs, cw = r["sw"]
-            cn, ce = r["ne"]
-            clat, clon = (cs + cn) / 2, (cw + ce) / 2
-            cx, cy = ll2grid(clon, clat)
-            continue
+            if r["name"] == "cell_name":
+                chart = r["cellname"] or chart
+                uband = get_uband(chart)
+                continue
 
-        if r["name"] == "node_table":
-            s = r.get("scale", 1)
-            for i, n in r["nodes"].items():
-                assert i not in node_table, f"duplicate node {i}"
-                node_table[i] = grid2ll(cx + n[0] / s, cy + n[1] / s)
-            continue
+            if r["name"] == "cell_extent":
+                cs, cw = r["sw"]
+                cn, ce = r["ne"]
+                clat, clon = (cs + cn) / 2, (cw + ce) / 2
+                cx, cy = ll2grid(clon, clat)
+                continue
 
-        if r["name"] == "edge_table":
-            s = r.get("scale", 1)
-            for i, e in r["edges"].items():
-                assert i not in edge_table, f"duplicate edge {i}"
-                edge_table[i] = [grid2ll(cx + n[0] / s, cy + n[1] / s) for n in e]
-            continue
+            if r["name"] == "node_table":
+                s = r.get("scale", 1)
+                for i, n in r["nodes"].items():
+                    assert i not in node_table, f"duplicate node {i}"
+                    node_table[i] = grid2ll(cx + n[0] / s, cy + n[1] / s)
+                continue
 
-        if r["name"] == "text" and txtdir:
-            with open(join(txtdir, r["file"]), "w") as f:
-                f.write(r["text"])
-            continue
+            if r["name"] == "edge_table":
+                s = r.get("scale", 1)
+                for i, e in r["edges"].items():
+                    assert i not in edge_table, f"duplicate edge {i}"
+                    edge_table[i] = [
+                        grid2ll(cx + n[0] / s, cy + n[1] / s) for n in e.tolist()
+                    ]
+                continue
 
-    props0 = {CHART: chart, "uband": uband, "scale": scale}
+            if r["name"] == "text" and txtdir:
+                with open(join(txtdir, r["file"]), "w") as f:
+                    f.write(r["text"])
+                continue
 
-    for r in recs:  # second pass
-        if r["name"] == "feature":
-            layer = layer_name(r["ftype"])
-            ptype = r["primitive"] + 1
-            props = props0.copy()
-            props["layer"] = layer
-            continue
+        props0 = {CHART: chart, "uband": uband, "scale": scale}
 
-        if r["name"] == "attribute":
-            props[attr_name(r["atype"])] = r["value"]
-            continue
+        for r in chain.from_iterable(senc.features(ftypes)):  # second pass
+            if r["name"] == "feature":
+                layer = layer_name(r["ftype"])
+                ptype = r["primitive"] + 1
+                props = props0.copy()
+                props["layer"] = layer
+                continue
 
-        if r["name"] == "point":
-            assert ptype == 1
-            p = Point((r["lon"], r["lat"]))
-            f = Feature(geometry=p, properties=props)
-            features.append(f)
-            continue
+            if r["name"] == "attribute":
+                props[attr_name(r["atype"])] = r["value"]
+                continue
 
-        if r["name"] == "multipoint":
-            assert ptype == 1
-            if multipoints:
-                p = MultiPoint(
-                    [
-                        grid2ll(cx + p[0], cy + p[1]) + (round(p[2], 1),)
-                        for p in r["points"]
-                    ]
-                )
+            if r["name"] == "point":
+                assert ptype == 1
+                p = Point((r["lon"], r["lat"]))
                 f = Feature(geometry=p, properties=props)
                 features.append(f)
-            else:
-                for x, y, depth in r["points"]:
-                    props["VALSOU"] = round(depth, 1)
-                    p = Point(grid2ll(cx + x, cy + y))
-                    f = Feature(geometry=p, properties=props.copy())
-                    features.append(f)
-            continue
+                continue
 
-        def contours(edgelist, pc=None):
-            line, lines, s, e = None, [], None, None
-            for n0, ed, n1, flip in edgelist:
-                if n0 != e:  # start of new segment
-                    # if e is None: # start of new segment
-                    if line:
-                        lines.append(line)
-                    line = []
-                    s = n0
-                    line.append(node_table[n0])
-                    # print('\nline',end=' ')
-                # print((n0,ed,n1),end=' ')
-                if ed in edge_table:
-                    line += (
-                        (reversed(edge_table[ed]) if flip else edge_table[ed])
-                        if ed
-                        else []
+            if r["name"] == "multipoint":
+                assert ptype == 1
+                if multipoints:
+                    p = MultiPoint(
+                        [
+                            grid2ll(cx + p[0], cy + p[1]) + (round(p[2], 1),)
+                            for p in r["points"].tolist()
+                        ]
                     )
-                elif ed:
-                    print("[red]skipped invalid edge[/]")
-                line.append(node_table[n1])
-                e = None if n1 == s else n1  # e=None if closed loop
-                # if pc and len(line)>=pc[len(lines)]: e=None
-            lines.append(line)
-            # print()
-            for l in lines:
-                for a, b in zip(l[:-1], l[1:]):
-                    if a == b:
-                        print("[red]repeated nodes[/]")
-            return lines
-
-        if r["name"] == "line":
-            assert ptype == 2
-            lines = contours(r["edges"])
-            l = LineString(lines[0]) if len(lines) == 1 else MultiLineString(lines)
-            f = Feature(geometry=l, properties=props)
-            features.append(f)
-            continue
+                    f = Feature(geometry=p, properties=props)
+                    features.append(f)
+                else:
+                    for x, y, depth in r["points"].tolist():
+                        props["VALSOU"] = round(depth, 1)
+                        p = Point(grid2ll(cx + x, cy + y))
+                        f = Feature(geometry=p, properties=props.copy())
+                        features.append(f)
+                continue
 
-        if r["name"] == "area":
-            assert ptype == 3
-            assert r["contours"] == len(r["pointcount"]), (
-                r["contours"],
-                len(r["pointcount"]),
-            )
-            # print(r['contours'])
-            lines = contours(r["edges"], r["pointcount"])
-            # assert len(lines)==r['contours'],(len(lines),r['contours'])
-            for i, l in enumerate(lines):
-                assert l[0] == l[-1], "polygon not closed"
-                # assert len(l)==r['pointcount'][i],(len(l),r['pointcount'][i])
-            l = Polygon(lines)
-            f = Feature(geometry=l, properties=props)
-            features.append(f)
-            continue
+            def contours(edgelist, pc=None):
+                line, lines, s, e = None, [], None, None
+                for n0, ed, n1, flip in edgelist:
+                    if n0 != e:  # start of new segment
+                        # if e is None: # start of new segment
+                        if line:
+                            lines.append(line)
+                        line = []
+                        s = n0
+                        line.append(node_table[n0])
+                        # print('\nline',end=' ')
+                    # print((n0,ed,n1),end=' ')
+                    if ed in edge_table:
+                        line += (
+                            (reversed(edge_table[ed]) if flip else edge_table[ed])
+                            if ed
+                            else []
+                        )
+                    elif ed:
+                        print("[red]skipped invalid edge[/]")
+                    line.append(node_table[n1])
+                    e = None if n1 == s else n1  # e=None if closed loop
+                    # if pc and len(line)>=pc[len(lines)]: e=None
+                lines.append(line)
+                # print()
+                for l in lines:
+                    for a, b in zip(l[:-1], l[1:]):
+                        if a == b:
+                            print("[red]repeated nodes[/]")
+                return lines
+
+            if r["name"] == "line":
+                assert ptype == 2
+                lines = contours(r["edges"].tolist())
+                l = LineString(lines[0]) if len(lines) == 1 else MultiLineString(lines)
+                f = Feature(geometry=l, properties=props)
+                features.append(f)
+                continue
 
-    return features
+            if r["name"] == "area":
+                assert ptype == 3
+                assert r["contours"] == len(r["pointcount"]), (
+                    r["contours"],
+                    len(r["pointcount"]),
+                )
+                # print(r['contours'])
+                lines = contours(r["edges"].tolist(), r["pointcount"])
+                # assert len(lines)==r['contours'],(len(lines),r['contours'])
+                for i, l in enumerate(lines):
+                    assert l[0] == l[-1], "polygon not closed"
+                    # assert len(l)==r['pointcount'][i],(len(l),r['pointcount'][i])
+                l = Polygon(lines)
+                f = Feature(geometry=l, properties=props)
+                features.append(f)
+                continue
+
+        return features
 
 
 def write_json(filename, data, **kwargs):
@@ -690,6 +720,12 @@ def main():
         "-u", "--uband", help="override usage band (1-6), sets native scale", type=int
     )
     parser.add_argument("-c", "--chart", help="override chart field")
+    parser.add_argument(
+        "-l",
+        "--layers",
+        help="only extract these layers (SENC --> GeoJSON), e.g. SOUNDG DEPARE",
+        nargs="+",
+    )
     parser.add_argument(
         "-j",
         "--jitter",
@@ -698,6 +734,10 @@ def main():
         default=0,
     )
     args = parser.parse_args()
+    try:
+        layer_codes(args.layers or [])
+    except ValueError as e:
+        parser.error(str(e))
 
     files = args.input
     out = args.output
@@ -765,7 +805,7 @@ def main():
     features = []
     for f in track(files, "reading SENCs"):
         print(f)
-        features += senc2features(f, out)
+        features += senc2features(f, out, layers=args.layers)
 
     for l in track(
         sorted({f.properties["layer"] for f in features}), "writing GeoJSON"
@@ -9,12 +9,20 @@ The SENC library by o-charts can read both formats, S57 is indicated by file ver
 
 https://github.com/OpenCPN/OpenCPN/blob/master/gui/include/gui/Osenc.h
 https://github.com/bdbcat/o-charts_pi/blob/master/src/Osenc.h
+
+Geometry tables are read and written as numpy arrays, numpy is required.
 """
 
+import mmap
+import os
 import struct
+from collections import defaultdict
+from functools import lru_cache
 from math import atan, degrees, exp, log, pi, radians, tan
 from os.path import dirname, join
 
+import numpy as np
+
 HEADER_SENC_VERSION = 1
 HEADER_CELL_NAME = 2
 HEADER_CELL_PUBLISHDATE = 3
@@ -44,6 +52,12 @@ VECTOR_CONNECTED_NODE_TABLE_EXT_RECORD = 86
 
 S57_RECORD_TYPES = 1, 2, 3, 4, 5, 6, 7, 8, 64, 65, 80, 81, 82, 83, 96, 97, 98, 99, 100
 
+# records following a feature id record that belong to the feature
+FEATURE_RECORD_TYPES = 65, 80, 81, 82, 83, 84
+
+# node and edge tables referenced by lines and areas
+TABLE_RECORD_TYPES = 85, 86, 96, 97
+
 R = 6378137.0
 
 
@@ -59,33 +73,33 @@ def grid2ll(easting, northing):
     return lon, lat
 
 
-def multipoint(data, unpack=None, pack=None):
+def multipoint(data, unpack=None, pack=None, array=None, pack_array=None):
     if unpack:
-        data["points"] = [unpack("fff") for i in range(data["count"])]
+        data["points"] = array("fff", data["count"])
 
     if pack:
         points = data["points"]
         assert len(points) == data["count"]
-        for p in points:
-            pack("fff", *p)
+        pack_array("fff", points)
 
 
-def line(data, unpack=None, pack=None):
+def line(data, unpack=None, pack=None, array=None, pack_array=None):
     stride = data["stride"]
     fmt = "I" * stride
 
     if unpack:
-        pad = (0,) * (4 - stride)
-        data["edges"] = [unpack(fmt) + pad for i in range(data["count"])]
+        edges = array(fmt, data["count"])
+        if stride < 4:
+            edges = np.hstack((edges, np.zeros((len(edges), 4 - stride), edges.dtype)))
+        data["edges"] = edges
 
     if pack:
         edges = data["edges"]
         assert len(edges) == data["count"]
-        for e in edges:
-            pack(fmt, *e[:stride])
+        pack_array(fmt, [e[:stride] for e in edges])
 
 
-def area(data, unpack=None, pack=None):
+def area(data, unpack=None, pack=None, array=None, pack_array=None):
     if unpack:
         contours, tris = [data[k] for k in ("contours", "trias")]
         pointcount = unpack(f"{contours}I")
@@ -94,7 +108,7 @@ def area(data, unpack=None, pack=None):
         for t in range(tris):
             ttype, nvert = unpack("BI")
             bbox = unpack("dddd")
-            vertices = [unpack("ff") for i in range(nvert)]
+            vertices = array("ff", nvert)
             triangles.append({"ttype": ttype, "bbox": bbox, "vertices": vertices})
 
     if pack:
@@ -107,19 +121,18 @@ def area(data, unpack=None, pack=None):
         for t in triangles:
             tt, bb, vs = t["ttype"], t["bbox"], t["vertices"]  # bbox=WESN
             pack("BIdddd", tt, len(vs), *bb)
-            for v in vs:
-                pack("ff", *v)
+            pack_array("ff", vs)
 
-    line(data, unpack, pack)
+    line(data, unpack, pack, array, pack_array)
 
 
-def edge_table(data, unpack=None, pack=None):
+def edge_table(data, unpack=None, pack=None, array=None, pack_array=None):
     if unpack:
         edges = {}
         for i in range(data["count"]):
             index, points = unpack("II")
             assert index
-            edges[index] = [unpack("ff") for j in range(points)]
+            edges[index] = array("ff", points)
         data["edges"] = edges
 
     if pack:
@@ -127,24 +140,20 @@ def edge_table(data, unpack=None, pack=None):
         assert len(edges) == data["count"]
         for i, vs in edges.items():
             pack("II", i, len(vs))
-            for v in vs:
-                pack("ff", *v)
+            pack_array("ff", vs)
 
 
-def node_table(data, unpack=None, pack=None):
+def node_table(data, unpack=None, pack=None, array=None, pack_array=None):
     if unpack:
-        nodes = {}
-        for i in range(data["count"]):
-            index = unpack("I")[0]
-            assert index
-            nodes[index] = unpack("ff")
-        data["nodes"] = nodes
+        a = array("Iff", data["count"])
+        index, x, y = (a[k].tolist() for k in a.dtype.names)
+        assert all(index)
+        data["nodes"] = dict(zip(index, zip(x, y)))
 
     if pack:
         nodes = data["nodes"]
         assert len(nodes) == data["count"]
-        for i, n in nodes.items():
-            pack("Iff", i, *n)
+        pack_array("Iff", [(i, *n) for i, n in nodes.items()])
 
 
 RECORDS = {
@@ -224,6 +233,74 @@ RECORDS = {
 }
 
 
+@lru_cache(maxsize=None)
+def layout(fmt):
+    "compiled struct for a format string"
+    return struct.Struct(fmt)
+
+
+def compile_record(fields, bo="<"):
+    """compile the field specs of a RECORDS entry into (name, steps)
+
+    runs of fixed size fields are merged into one struct, formats depending on
+    earlier fields ({...}) and strings are resolved at runtime"""
+    name, steps, run = None, [], []
+
+    def flush():
+        if run:
+            s = layout(bo + "".join(fmt for _, fmt, _ in run))
+            steps.append(("fixed", s, [(n, c) for n, _, c in run]))
+            run.clear()
+
+    for f in fields:
+        if callable(f):
+            flush()
+            steps.append(("call", f))
+            continue
+        if ":" not in f:
+            name = f
+            continue
+        n, fmt = f.split(":")
+        if "{" in fmt:
+            flush()
+            steps.append(("dynamic", n, eval(f'lambda d: f"{fmt}"')))
+        elif fmt == "z":
+            flush()
+            steps.append(("field", n, fmt))
+        else:
+            s = layout(bo + fmt)
+            run.append((n, fmt, len(s.unpack(bytes(s.size)))))
+    flush()
+    return name, steps
+
+
+@lru_cache(maxsize=None)
+def record_layouts(bo="<"):
+    return {t: compile_record(fields, bo) for t, fields in RECORDS.items()}
+
+
+def checked_cast(values, dtype):
+    "values as numpy array of dtype, fail like struct.pack if they don't fit"
+    a, dt = np.asarray(values), np.dtype(dtype)
+    if not a.size:
+        return a.astype(dt)
+    if dt.kind in "iu":
+        if a.dtype.kind not in "biu":
+            raise struct.error("required argument is not an integer")
+        i = np.iinfo(dt)
+        if a.min() < i.min or a.max() > i.max:
+            raise struct.error(
+                f"{dt.char!r} format requires {i.min} <= number <= {i.max}"
+            )
+    else:
+        try:
+            with np.errstate(over="raise"):
+                return a.astype(dt)
+        except FloatingPointError:
+            raise OverflowError(f"float too large to pack with {dt.char} format")
+    return a.astype(dt)
+
+
 class SENC:
     "reads/writes an SENC/S57 file to/from dicts"
 
@@ -233,19 +310,32 @@ class SENC:
         self._BO = "<"
         self._stride = 4 if filename.endswith(".senc") else 3
         self._fid = 0
+        self._layouts = record_layouts(self._BO)
 
     def __enter__(self):
         assert not hasattr(self, "_fd")
-        self._fd = open(self.filename, "wb" if self._writeable else "rb")
         self._limit = None
-        if self._writeable:
+        if self._writeable:  # complete records are written in large blocks
+            self._fd = open(self.filename, "wb", buffering=1 << 20)
             ver = 201 if self._stride == 4 else 200
             self.add_record(type=HEADER_SENC_VERSION, version=ver)
+        else:  # records are decoded from a memory map of the file
+            self._fd = open(self.filename, "rb")
+            fd = self._fd.fileno()
+            mm = (
+                mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+                if os.fstat(fd).st_size
+                else b""
+            )
+            self._map, self._buf, self._offset = mm, memoryview(mm), 0
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         self._fd.close()
         del self._fd
+        if not self._writeable:
+            del self._map, self._buf  # arrays read from the file keep the map alive
+            self.__dict__.pop("_index", None)
 
     def __iter__(self):
         return self
@@ -261,52 +351,118 @@ class SENC:
         with self as s:
             return list(s)
 
+    def index(self):
+        """scan the record headers only, skipping payloads
+
+        returns the offsets of the records by type and a list of the features
+        as ((ftype, id, primitive), offsets of the feature records) in file
+        order, ids are not unique as they are only 16 bits"""
+        if not hasattr(self, "_index"):
+            head = layout(self._BO + "HI")
+            feature = layout(self._BO + "HHB")
+            types, features = defaultdict(list), []
+            o, n = 0, len(self._buf)
+            while o + head.size <= n:
+                t, size = head.unpack_from(self._buf, o)
+                assert size >= head.size, f"invalid record size {size} at {o}"
+                types[t].append(o)
+                if t == FEATURE_ID_RECORD:
+                    features.append((feature.unpack_from(self._buf, o + 6), [o]))
+                elif t in FEATURE_RECORD_TYPES and features:
+                    features[-1][1].append(o)
+                o += size
+            self._index = dict(types), features
+        return self._index
+
+    def record(self, offset):
+        "read the record at offset"
+        self._offset, self._limit = offset, None
+        return self.get_record()
+
+    def features(self, ftypes=None):
+        "yield the records of each feature, optionally of some feature types only"
+        for (ftype, id, primitive), offsets in self.index()[1]:
+            if ftypes is None or ftype in ftypes:
+                yield [self.record(o) for o in offsets]
+
     def limit(self, n=None):
         "set/get read limit relative to current position"
         if n is not None:
             self._limit = None if n < 0 else n
         return self._limit
 
-    def read(self, n, exactly=False):
-        "read (exactly) n bytes, enforce limit"
+    def advance(self, n, exactly=False):
+        "advance (exactly) n bytes, enforce limit, return previous position"
         if self._limit is not None:
             assert self._limit - n >= 0, f"limit exceeded: {self._limit}"
             self._limit -= n
-        data = self._fd.read(n)
-        assert not exactly or len(data) == n, f"not exactly: {len(data)}<{n}"
-        return data
+        o = self._offset
+        self._offset = min(o + n, len(self._buf))
+        assert not exactly or self._offset - o == n, (
+            f"not exactly: {self._offset - o}<{n}"
+        )
+        return o
+
+    def read(self, n, exactly=False):
+        "read (exactly) n bytes, enforce limit, returns a view of the file"
+        o = self.advance(n, exactly)
+        return self._buf[o : self._offset]
+
+    def array(self, fmt, n):
+        """read n items of fmt as numpy array viewing the file
+
+        homogeneous formats give n rows of len(fmt) values, others n records
+        with fields f0, f1..."""
+        if len(set(fmt)) == 1:
+            dt, k = np.dtype(self._BO + fmt[0]), len(fmt)
+        else:
+            dt, k = np.dtype([(f"f{i}", self._BO + c) for i, c in enumerate(fmt)]), 1
+        o = self.advance(n * k * dt.itemsize, True)
+        a = np.frombuffer(self._buf, dt, n * k, o)
+        return a.reshape(n, k) if k > 1 else a
 
     def unpack(self, fmt):
         "read data from file"
-        if fmt == "z":  # zero terminated string
-            s = b""
-            while True:
-                c = self.unpack("s")[0]
-                if c != b"\0":
-                    s += c
-                else:
-                    break
-            # print('<z',s.decode())
-            return s.decode()
-        n = struct.calcsize(self._BO + fmt)
-        b = self.read(n)
-        if len(b) != n:
+        if fmt == "z":  # zero terminated string, search NUL within the record
+            o = self._offset
+            end = len(self._buf) if self._limit is None else o + self._limit
+            i = self._map.find(b"\0", o, end)
+            assert i >= 0, f"unterminated string at {o}"
+            self.advance(i + 1 - o)
+            # print('<z',self._map[o:i].decode())
+            return self._map[o:i].decode()
+        s = layout(self._BO + fmt)
+        o = self.advance(s.size)
+        if self._offset - o != s.size:
             return
-        return struct.unpack(self._BO + fmt, b)
+        return s.unpack_from(self._buf, o)
 
     def pack(self, fmt, *vals):
-        "write data to file"
+        "write data to the current record"
         if fmt == "z":
             # print('>z',vals[0])
-            self._fd.write(vals[0].encode() + b"\0")
+            self._rec += vals[0].encode() + b"\0"
         else:
-            self._fd.write(struct.pack(self._BO + fmt, *vals))
+            self._rec += layout(self._BO + fmt).pack(*vals)
+
+    def pack_array(self, fmt, rows):
+        "write rows of fmt from a numpy array or a sequence of tuples"
+        if len(set(fmt)) == 1:
+            a = checked_cast(rows, self._BO + fmt[0])
+            assert a.size == len(rows) * len(fmt), f"not {len(rows)} rows of {fmt}"
+        else:
+            a = np.empty(
+                len(rows), [(f"f{i}", self._BO + c) for i, c in enumerate(fmt)]
+            )
+            for i, (c, col) in enumerate(zip(fmt, zip(*rows))):
+                a[f"f{i}"] = checked_cast(col, self._BO + c)
+        self._rec += a.tobytes()
 
     def get_type(self):
         "return next record type, set limit"
         l = self.limit()
         if l:
-            self._fd.seek(l)  # skip to next record
+            self.advance(l)  # skip to next record
         self.limit(-1)
         h = self.unpack("HI")
         if h:
@@ -314,53 +470,58 @@ class SENC:
             return h[0]
 
     def start_record(self, rtype):
-        assert not hasattr(self, "_pos")
+        assert not hasattr(self, "_rec")
         assert self._stride == 4 or rtype in S57_RECORD_TYPES, (
             f"record type {rtype} {RECORDS[rtype][0]} not allowed in S57"
         )
-        self._pos = self._fd.tell()
+        self._rec = bytearray()  # record is assembled in memory
         self.pack("HI", rtype, 0)
 
     def end_record(self, s=None, revert=False):
         if revert:
-            self._fd.seek(self._pos)
-            del self._pos
+            del self._rec
             return
-        size = self._fd.tell() - self._pos
+        size = len(self._rec)
         # print('> size',size-6)
         assert s is None or size - 6 == s, (size - 6, s)
-        self._fd.seek(self._pos + 2, 0)
-        self.pack("I", size)
-        self._fd.seek(0, 2)
-        del self._pos
+        layout(self._BO + "I").pack_into(self._rec, 2, size)
+        self._fd.write(self._rec)
+        del self._rec
 
     def get_record(self):
         t = self.get_type()
         if not t:
             return
-        fields = RECORDS[t]
-        # print(fields)
-        d = data = {"type": t, "size": self.limit(), "stride": self._stride}
-        for f in fields:
-            if callable(f):
-                f(data, self.unpack)
-                continue
-            if ":" not in f:
-                data["name"] = f
-                continue
-            name, fmt = f.split(":")
-            fmt = eval(f'f"{fmt}"')
-            # print(name,fmt)
-            val = self.unpack(fmt)
-            # print(val)
-            data[name] = val[0] if len(val) == 1 else val
+        name, steps = self._layouts[t]
+        data = {"type": t, "size": self.limit(), "stride": self._stride}
+        if name:
+            data["name"] = name
+        for step in steps:
+            kind = step[0]
+            if kind == "fixed":
+                s, names = step[1:]
+                vals = s.unpack_from(self._buf, self.advance(s.size, True))
+                i = 0
+                for n, c in names:
+                    data[n] = vals[i] if c == 1 else vals[i : i + c]
+                    i += c
+            elif kind == "call":
+                step[1](data, self.unpack, array=self.array)
+            else:
+                n, fmt = step[1:]
+                if kind == "dynamic":
+                    fmt = fmt(data)
+                # print(n,fmt)
+                val = self.unpack(fmt)
+                # print(val)
+                data[n] = val[0] if len(val) == 1 else val
 
         assert not self.limit(), f"remaining bytes: {self.limit()}"
         return data
 
     def add_record(self, **data):
         t = data["type"]
-        fields = RECORDS[t]
+        steps = self._layouts[t][1]
         if "edges" in data:
             data["stride"] = self._stride
             data["count"] = len(data["edges"])
@@ -386,21 +547,27 @@ class SENC:
         self.start_record(t)
         try:
             # print('>',data)
-            d = data
-            for f in fields:
-                if callable(f):
-                    # print('>',f)
-                    f(data, pack=self.pack)
-                    continue
-                if ":" not in f:
-                    continue
-                name, fmt = f.split(":")
-                fmt = eval(f'f"{fmt}"')
-                val = data[name]
-                # print('>',name,fmt0,fmt,val)
-                if len(fmt) == 1:
-                    val = [val]
-                self.pack(fmt, *val)
+            for step in steps:
+                kind = step[0]
+                if kind == "fixed":
+                    s, names = step[1:]
+                    vals = []
+                    for n, c in names:
+                        v = data[n]
+                        vals += [v] if c == 1 else v
+                    self._rec += s.pack(*vals)
+                elif kind == "call":
+                    # print('>',step[1])
+                    step[1](data, pack=self.pack, pack_array=self.pack_array)
+                else:
+                    n, fmt = step[1:]
+                    if kind == "dynamic":
+                        fmt = fmt(data)
+                    val = data[n]
+                    # print('>',n,fmt,val)
+                    if len(fmt) == 1:
+                        val = [val]
+                    self.pack(fmt, *val)
             self.end_record()
         except Exception as x:
             print("reverted", x, data)
@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+import json
+import platform
+import random
+import time
+from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
+from contextlib import contextmanager
+from copy import deepcopy
+from math import cos, radians, sqrt
+from pathlib import Path
+from types import SimpleNamespace
+
+import pendulum
+from lxml import etree
+from pyquery import PyQuery as pq
+from rich import print
+
+import update
+
+try:
+    from rich_argparse import (
+        ArgumentDefaultsRichHelpFormatter as ArgumentDefaultsHelpFormatter,
+    )
+except:
+    pass
+
+# S-57 object class: variants of attributes, OSM tags and light colour
+SEAMARKS = {
+    "BOYLAT": [
+        (
+            {"boyshp": "2", "catlam": "1", "colour": "3"},
+            {
+                "seamark:type": "buoy_lateral",
+                "seamark:buoy_lateral:shape": "can",
+                "seamark:buoy_lateral:category": "port",
+                "seamark:buoy_lateral:colour": "red",
+            },
+            ("3", "red"),
+        ),
+        (
+            {"boyshp": "1", "catlam": "2", "colour": "4"},
+            {
+                "seamark:type": "buoy_lateral",
+                "seamark:buoy_lateral:shape": "conical",
+                "seamark:buoy_lateral:category": "starboard",
+                "seamark:buoy_lateral:colour": "green",
+            },
+            ("4", "green"),
+        ),
+    ],
+    "BOYCAR": [
+        (
+            {"boyshp": "4", "catcam": str(i), "colour": "2,6", "colpat": "1"},
+            {
+                "seamark:type": "buoy_cardinal",
+                "seamark:buoy_cardinal:shape": "pillar",
+                "seamark:buoy_cardinal:category": c,
+                "seamark:buoy_cardinal:colour": "black;yellow",
+                "seamark:buoy_cardinal:colour_pattern": "horizontal",
+                "seamark:topmark:colour": "black",
+                "seamark:topmark:shape": t,
+            },
+            ("1", "white"),
+        )
+        for i, c, t in [
+            (1, "north", "2 cones up"),
+            (2, "east", "2 cones base together"),
+            (3, "south", "2 cones down"),
+            (4, "west", "2 cones point together"),
+        ]
+    ],
+    "BCNLAT": [
+        (
+            {"catlam": "1", "colour": "3"},
+            {
+                "seamark:type": "beacon_lateral",
+                "seamark:beacon_lateral:category": "port",
+                "seamark:beacon_lateral:colour": "red",
+            },
+            ("3", "red"),
+        ),
+        (
+            {"catlam": "2", "colour": "4"},
+            {
+                "seamark:type": "beacon_lateral",
+                "seamark:beacon_lateral:category": "starboard",
+                "seamark:beacon_lateral:colour": "green",
+            },
+            ("4", "green"),
+        ),
+    ],
+}
+LIGHTS = "LIGHTS"
+
+
+def feature(lat, lon, props, band="DE4Approach"):
+    return {
+        "type": "Feature",
+        "id": f"{band}.{props['lnam']}",
+        "geometry": {"type": "Point", "coordinates": [lon, lat]},
+        "properties": props,
+    }
+
+
+def generate(odir, n, dups=0.05, jitter=0.5, seed=1):
+    """write n synthetic seamarks as ENC layers (GeoJSON) and as OSM file
+
+    about 10% exist only in the source (added), 5% only in OSM (removal
+    candidates), a fraction dups is duplicated in both (other usage band in
+    the source, a second node nearby in OSM), OSM positions are off by
+    jitter meters (standard deviation)"""
+    rnd = random.Random(seed)
+    odir.mkdir(parents=True, exist_ok=True)
+    layers = {k: [] for k in list(SEAMARKS) + [LIGHTS]}
+    nodes = []
+
+    # keep density constant, about one seamark per square km
+    size = sqrt(n) / 100
+    lat0, lon0 = 54.0, 7.0
+    dlat = jitter / 111e3
+    dlon = dlat / cos(radians(lat0))
+
+    def node(lat, lon, tags):
+        nodes.append((len(nodes) + 1, lat, lon, tags))
+
+    for i in range(n):
+        lat = lat0 + rnd.random() * size
+        lon = lon0 + rnd.random() * size / cos(radians(lat0))
+        k = rnd.choice(list(SEAMARKS))
+        props, tags, light = rnd.choice(SEAMARKS[k])
+        lnam = f"DE{i:014X}"
+        name = f"{k[:1]}{i}"
+        props = dict(props, lnam=lnam, objnam=name, scamin=22000, lnam_refs=[])
+        tags = dict(tags, **{"seamark:name": name})
+        if rnd.random() < 0.3:
+            ref = f"LI{i:014X}"
+            props["lnam_refs"].append(ref)
+            light_props = {"lnam": ref, "litchr": "2", "sigper": 4, "scamin": 22000}
+            light_props["colour"] = light[0]
+            layers[LIGHTS].append(feature(lat, lon, light_props))
+            tags["seamark:light:character"] = "Fl"
+            tags["seamark:light:colour"] = light[1]
+            tags["seamark:light:period"] = "4"
+        if rnd.random() < 0.9:
+            tags["seamark:lnam"] = lnam
+        if rnd.random() < 0.1:
+            tags["seamark:name"] += "x"  # outdated in OSM
+
+        r, dup = rnd.random(), rnd.random() < dups
+        if r < 0.95:
+            layers[k].append(feature(lat, lon, props))
+            if dup:
+                props = dict(props, scamin=90000)
+                layers[k].append(feature(lat, lon, props, "DE3Coastal"))
+        if r >= 0.1:
+            lat, lon = lat + rnd.gauss(0, dlat), lon + rnd.gauss(0, dlon)
+            node(lat, lon, tags)
+            if dup:
+                node(lat + rnd.gauss(0, dlat), lon + rnd.gauss(0, dlon), dict(tags))
+
+    for k, features in layers.items():
+        with open(odir / f"{k}.json", "w") as f:
+            json.dump({"type": "FeatureCollection", "features": features}, f)
+
+    rnd.shuffle(nodes)
+    with etree.xmlfile(str(odir / "osm.osm"), encoding="utf-8") as xf:
+        xf.write_declaration()
+        with xf.element("osm", version="0.6", generator="update-benchmark.py"):
+            for id, lat, lon, tags in nodes:
+                e = etree.Element(
+                    "node",
+                    id=str(id),
+                    version="1",
+                    timestamp="2020-01-01T00:00:00Z",
+                    user="benchmark",
+                    lat=f"{lat:.7f}",
+                    lon=f"{lon:.7f}",
+                )
+                for k, v in tags.items():
+                    etree.SubElement(e, "tag", k=k, v=v)
+                xf.write(e)
+
+    return {"nodes": len(nodes)} | {k: len(v) for k, v in layers.items()}
+
+
+@contextmanager
+def offline():
+    "silence update.py and keep it from talking to JOSM"
+    patches = {
+        "print": lambda *a, **k: None,
+        "track": lambda it, *a, **k: it,
+        "requests": SimpleNamespace(get=lambda *a, **k: None),
+    }
+    saved = {k: vars(update)[k] for k in patches if k in vars(update)}
+    vars(update).update(patches)
+    try:
+        yield
+    finally:
+        for k in patches:
+            vars(update).pop(k)
+        vars(update).update(saved)
+
+
+@contextmanager
+def profiled(stats, stage, obj, *attrs):
+    "accumulate time spent in obj.attr calls under stats[stage]"
+    saved = {a: getattr(obj, a) for a in attrs}
+
+    def wrap(f):
+        def wrapper(*args, **kwargs):
+            t0 = time.monotonic()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                stats[stage] = stats.get(stage, 0) + time.monotonic() - t0
+
+        return wrapper
+
+    for a, f in saved.items():
+        setattr(obj, a, wrap(f))
+    try:
+        yield
+    finally:
+        for a, f in saved.items():
+            setattr(obj, a, f)
+
+
+class XMLWriter:
+    "etree.xmlfile writer that can be profiled, lxml's own is immutable"
+
+    def __init__(self, xf):
+        self.xf = xf
+
+    def __getattr__(self, a):
+        return getattr(self.xf, a)
+
+    def write(self, *args, **kwargs):
+        return self.xf.write(*args, **kwargs)
+
+
+@contextmanager
+def profiled_xmlfile(stats, stage):
+    "accumulate time spent in etree.xmlfile writes under stats[stage]"
+    xmlfile = etree.xmlfile
+
+    @contextmanager
+    def wrapper(*args, **kwargs):
+        with xmlfile(*args, **kwargs) as xf:
+            yield XMLWriter(xf)
+
+    etree.xmlfile = wrapper
+    try:
+        with profiled(stats, stage, XMLWriter, "write"):
+            yield
+    finally:
+        etree.xmlfile = xmlfile
+
+
+def timed(stats, stage, f, *args, **kwargs):
+    t0 = time.monotonic()
+    r = f(*args, **kwargs)
+    stats[stage] = stats.get(stage, 0) + time.monotonic() - t0
+    return r
+
+
+def run_update(stats, prefix, infile, points, outfile, stream):
+    s = {}
+    with (
+        profiled(
+            s, "matching", update.PointIndex, "__init__", "near", "lnam", "consume"
+        ),
+        profiled(s, "update_node", update, "update_node"),
+        profiled(s, "serialization", etree, "tostring", "indent"),
+        profiled_xmlfile(s, "serialization"),
+    ):
+        t = timed(
+            s,
+            "total",
+            update.update_osm,
+            infile,
+            deepcopy(points),
+            outfile,
+            add=False,
+            remove=True,
+            sm_type=".*",
+            stream=stream,
+        )
+    s["other"] = s["total"] - sum(v for k, v in s.items() if k != "total")
+    stats.update({f"{prefix}_{k}": v for k, v in s.items()})
+    return t
+
+
+def benchmark(n, workdir, dups, jitter, seed):
+    d = Path(workdir) / str(n)
+    stats = {}
+    counts = timed(stats, "generate", generate, d, n, dups, jitter, seed)
+    update.translate_cache.clear()  # start cold for each size
+    update.translate_stats.update(hits=0, misses=0)
+    osm = str(d / "osm.osm")
+
+    with offline():
+        layers = [str(d / f"{k}.json") for k in SEAMARKS]
+        data = [
+            f
+            for l in layers
+            for f in timed(stats, "load_geojson", update.load_enc_file, l)
+        ]
+        other = timed(
+            stats, "load_geojson", update.load_enc_file, str(d / f"{LIGHTS}.json")
+        )
+        other = {k: v[0] for k, v in update.group_by(other, update.get_lnam).items()}
+        points = timed(stats, "translation", update.translate_enc, data, other)
+
+        x = timed(stats, "parse", pq, filename=osm)
+        timed(stats, "bounds", update.get_bounds, x)
+        timed(stats, "bounds_stream", update.get_bounds_stream, osm)
+        del x
+
+        run_update(stats, "dom", osm, points, str(d / "dom.osm"), False)
+        run_update(stats, "stream", osm, points, str(d / "stream.osm"), True)
+
+    counts["points"] = len(points)
+    counts["translate_cache"] = update.translate_cache_info()
+    return counts, stats
+
+
+def main():
+    parser = ArgumentParser(
+        description="benchmark of the update.py pipeline on synthetic data",
+        formatter_class=ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("output", help="JSON file to write results to")
+    parser.add_argument(
+        "-n",
+        "--sizes",
+        help="number of seamarks",
+        type=int,
+        nargs="+",
+        default=[1000, 10000, 100000],
+    )
+    parser.add_argument(
+        "-d",
+        "--dir",
+        help="work dir for generated data",
+        default="benchmark",
+    )
+    parser.add_argument(
+        "-D",
+        "--dups",
+        help="fraction of duplicated seamarks",
+        type=float,
+        default=0.05,
+    )
+    parser.add_argument(
+        "--jitter",
+        help="std deviation of OSM node positions in meters",
+        type=float,
+        default=0.5,
+    )
+    parser.add_argument(
+        "-r",
+        "--repeat",
+        help="run each size N times, keep the fastest time per stage",
+        type=int,
+        default=1,
+        metavar="N",
+    )
+    parser.add_argument("--seed", help="random seed", type=int, default=1)
+    args = parser.parse_args()
+
+    results = {}
+    for n in args.sizes:
+        best = {}
+        for i in range(args.repeat):
+            print(f"[bold]{n}[/bold] seamarks, run {i + 1}/{args.repeat}")
+            counts, stats = benchmark(n, args.dir, args.dups, args.jitter, args.seed)
+            for k, v in stats.items():
+                best[k] = min(best.get(k, v), v)
+        results[n] = {"counts": counts, "times": best}
+
+        for k, v in best.items():
+            print(f"  {k:<22} {v:8.3f}s")
+
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "date": pendulum.now().isoformat(),
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "args": vars(args),
+                "results": results,
+            },
+            f,
+            indent=2,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+from lxml import etree
+from rich import print
+
+import update
+
+
+def node(tags):
+    e = etree.Element("node", id="1", version="1", lat="54.0", lon="10.0")
+    for k, v in tags.items():
+        etree.SubElement(e, "tag", k=k, v=v)
+    return update.Node(e)
+
+
+def check_type_change():
+    "a buoy that changed its type loses the tags of its old type"
+    n = node(
+        {
+            "seamark:type": "buoy_lateral",
+            "seamark:buoy_lateral:category": "port",
+            "seamark:buoy_lateral:colour": "red",
+            "seamark:light:colour": "red",
+        }
+    )
+    tags = {
+        "ll": (54.0, 10.0),
+        "seamark:type": "buoy_cardinal",
+        "seamark:buoy_cardinal:category": "north",
+        "seamark:buoy_cardinal:colour": "black;yellow",
+        "seamark:light:colour": "white",
+    }
+    m = update.update_node(n, tags)
+    assert ("DEL", "seamark:buoy_lateral:category=port") in m, m
+    assert ("DEL", "seamark:buoy_lateral:colour=red") in m, m
+    assert {k: t.get("v") for k, t in n._tags.items()} == {
+        k: v for k, v in tags.items() if k != "ll"
+    }, n.tags
+
+
+def check_same_type():
+    "a node of an unchanged type keeps its tags"
+    tags = {
+        "seamark:type": "beacon_lateral",
+        "seamark:beacon_lateral:category": "starboard",
+    }
+    n = node(tags)
+    assert update.update_node(n, dict(tags, ll=(54.0, 10.0))) == []
+    assert n.tags == tags, n.tags
+
+
+def main():
+    for name, f in list(globals().items()):
+        if name.startswith("check_"):
+            f()
+            print("[green]OK", name)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,11 +4,19 @@
 import json
 import os
 import re
+import sqlite3
 from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
-from functools import reduce
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from copy import deepcopy
+from glob import glob
+from hashlib import sha1
+from itertools import chain, product
 from math import inf, isfinite, isnan, log, pi, pow, sqrt, tan
+from os import makedirs
 from os.path import basename, isfile, splitext
 
+import numpy as np
 import pendulum
 import requests
 from lxml import etree
@@ -56,6 +64,82 @@ def distance(a, b):
     return sqrt(sum([pow(a[i] - b[i], 2) for i in range(2)]))
 
 
+def project(lls):
+    "latlon_to_grid for an array of (lat, lon), returns (n, 2) array"
+    ll = np.asarray(lls, dtype=float).reshape(-1, 2)
+    f = 20037508.34
+    with np.errstate(all="ignore"):
+        x = (ll[:, 1] * f) / 180
+        y = np.log(np.tan((90 + ll[:, 0]) * pi / 360)) / (pi / 180)
+        y = (y * f) / 180
+    return np.column_stack((x, y))
+
+
+class PointIndex:
+    "uniform grid hash of source points in web mercator meters, lnam hash"
+
+    def __init__(self, points, cell=250):
+        self.points = points
+        self.cell = cell
+        self.consumed = np.zeros(len(points), dtype=bool)
+        self.xy = project([p["ll"] for p in points])
+        grid = {}
+        finite = np.flatnonzero(np.isfinite(self.xy).all(axis=1))
+        cells = np.floor_divide(self.xy[finite], cell).astype(np.int64)
+        for i, k in zip(finite.tolist(), map(tuple, cells.tolist())):
+            grid.setdefault(k, []).append(i)
+        self.grid = {k: np.array(v, dtype=np.int64) for k, v in grid.items()}
+        self.lnams = {}
+        for i, p in enumerate(points):
+            lnam = p.get("seamark:lnam")
+            if lnam:
+                self.lnams.setdefault(lnam, []).append(i)
+
+    def key(self, x, y):
+        return int(x // self.cell), int(y // self.cell)
+
+    def near(self, xy, dist, filt=None):
+        "indices of unconsumed points within dist of xy, in original order"
+        x, y = xy
+        if not (isfinite(x) and isfinite(y)):
+            return []
+        cx, cy = self.key(x, y)
+        r = int(dist // self.cell) + 1
+        cells = [
+            self.grid[k]
+            for k in product(range(cx - r, cx + r + 1), range(cy - r, cy + r + 1))
+            if k in self.grid
+        ]
+        if not cells:
+            return []
+        ids = np.concatenate(cells)
+        ids = ids[~self.consumed[ids]]
+        d = self.xy[ids] - (x, y)
+        ids = np.sort(ids[np.sqrt(d[:, 0] ** 2 + d[:, 1] ** 2) <= dist])
+        return [i for i in ids.tolist() if not filt or filt(self.points[i])]
+
+    def distance(self, i, xy):
+        "distance of point i to xy"
+        px, py = self.xy[i]
+        return sqrt(pow(xy[0] - px, 2) + pow(xy[1] - py, 2))
+
+    def lnam(self, lnam):
+        "indices of unconsumed points with this lnam"
+        return list(self.lnams.get(lnam, ()))
+
+    def unconsumed(self):
+        return np.flatnonzero(~self.consumed).tolist()
+
+    def consume(self, i):
+        self.consumed[i] = True
+        lnam = self.points[i].get("seamark:lnam")
+        if lnam:
+            self.lnams[lnam].remove(i)
+
+    def remaining(self):
+        return [self.points[i] for i in self.unconsumed()]
+
+
 ubands = ["Approach", "Harbour", "Berthing"]
 # ubands = ["Approach"]
 
@@ -104,11 +188,45 @@ def get_bounds(xml):
             a: float(bounds.attr[a]) for a in ("minlat", "maxlat", "minlon", "maxlon")
         }
     b = {"minlat": +inf, "maxlat": -inf, "minlon": +inf, "maxlon": -inf}
-    for e in xml("node"):
-        n = pq(e)
-        if not n.attr["lat"]:
+    for e in xml.root.iter("node"):
+        if not e.get("lat"):
+            continue
+        ll = [float(e.get(a)) for a in ("lat", "lon")]
+        b["minlat"] = min(b["minlat"], ll[0])
+        b["maxlat"] = max(b["maxlat"], ll[0])
+        b["minlon"] = min(b["minlon"], ll[1])
+        b["maxlon"] = max(b["maxlon"], ll[1])
+    return b if isfinite(sum(b.values())) else None
+
+
+def iterparse_osm(infile):
+    "yield top level elements of an OSM file one at a time, free them afterwards"
+    depth = 0
+    for event, e in etree.iterparse(infile, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            yield e
+            e.clear()
+            while e.getprevious() is not None:
+                del e.getparent()[0]
+
+
+def get_root(infile):
+    for event, e in etree.iterparse(infile, events=("start",)):
+        return dict(e.attrib)
+
+
+def get_bounds_stream(infile):
+    b = {"minlat": +inf, "maxlat": -inf, "minlon": +inf, "maxlon": -inf}
+    for e in iterparse_osm(infile):
+        if e.tag == "bounds":
+            return {a: float(e.get(a)) for a in b.keys()}
+        if e.tag != "node" or not e.get("lat"):
             continue
-        ll = [float(n.attr[a]) for a in ("lat", "lon")]
+        ll = [float(e.get(a)) for a in ("lat", "lon")]
         b["minlat"] = min(b["minlat"], ll[0])
         b["maxlat"] = max(b["maxlat"], ll[0])
         b["minlon"] = min(b["minlon"], ll[1])
@@ -120,7 +238,12 @@ def get_lnam(f):
     return f["properties"]["lnam"]
 
 
-def load_geojson(filename, geotype="point", inject={}):
+def load_geojson(filename, geotype="point", inject={}, cache=None):
+    "load selected features, cache: dict to load each file only once"
+    key = filename, geotype, str(inject)
+    if cache is not None and key in cache:
+        return cache[key]
+
     print("loading GeoJSON", filename)
     data = load_json(filename)
     features = {}
@@ -156,6 +279,9 @@ def load_geojson(filename, geotype="point", inject={}):
     # print("other keys", keys.difference(S57keys.keys()))
     # print("types", types)
 
+    if cache is not None:
+        cache[key] = selected
+
     return selected
 
 
@@ -163,27 +289,17 @@ def load_geojson(filename, geotype="point", inject={}):
 # d = load_geojson(f)
 
 
-def load_enc(layer_files, other_files):
-    if isinstance(layer_files, str):
-        layer_files = [layer_files]
-    if isinstance(other_files, str):
-        other_files = [other_files]
-
-    def load(f):
-        try:
-            t = S57types.get(splitext(basename(f))[0])
-            t = {"_type_": t} if t else {}
-            return load_geojson(f, inject=t)
-        except Exception as x:
-            print(x, f)
-            return []
+def load_enc_file(f):
+    try:
+        t = S57types.get(splitext(basename(f))[0])
+        t = {"_type_": t} if t else {}
+        return load_geojson(f, inject=t)
+    except Exception as x:
+        print(x, f)
+        return []
 
-    data, other = [
-        reduce(lambda a, b: a + b, [load(f) for f in files], [])
-        for files in (layer_files, other_files)
-    ]
-    other = {k: v[0] for k, v in group_by(other, get_lnam).items()}
 
+def translate_enc(data, other):
     points = []
     for f in data:
         ll = latlon(f)
@@ -215,6 +331,41 @@ def load_enc(layer_files, other_files):
         #         print(k, "=", v)
 
         points.append(tags)
+    return points
+
+
+def load_enc(layer_files, other_files, jobs=None):
+    if isinstance(layer_files, str):
+        layer_files = [layer_files]
+    if isinstance(other_files, str):
+        other_files = [other_files]
+
+    # jobs=None or <= 0: one process per core, jobs=1: no process pool
+    if jobs is not None and jobs <= 0:
+        jobs = None
+    with ProcessPoolExecutor(jobs) if jobs != 1 else nullcontext() as pool:
+        pmap = pool.map if pool else map
+
+        data, other = [
+            list(chain.from_iterable(pmap(load_enc_file, files)))
+            for files in (layer_files, other_files)
+        ]
+        other = {k: v[0] for k, v in group_by(other, get_lnam).items()}
+
+        n = jobs or os.cpu_count() or 1
+        size = len(data) // n + 1
+        chunks = [data[i : i + size] for i in range(0, len(data), size)]
+        # each chunk gets only the referenced features, not all of other
+        others = [
+            {
+                r: other[r]
+                for f in c
+                for r in f["properties"].get("lnam_refs") or []
+                if r in other
+            }
+            for c in chunks
+        ]
+        points = list(chain.from_iterable(pmap(translate_enc, chunks, others)))
 
     g = group_by(points, smtype)
     print("\n".join([f">{k} {len(v)}" for k, v in g.items()]))
@@ -242,6 +393,7 @@ def load_enc_layers(
         # "OBSTRN",
     ),
     others=layers2,
+    jobs=None,
 ):
     def filelist(directory, layers):
         files = [f"{datadir}/{l}.json" for l in layers]
@@ -251,14 +403,15 @@ def load_enc_layers(
     return load_enc(
         filelist(datadir, layers),
         filelist(datadir, others),
+        jobs,
     )
 
 
 # load_enc_layers("data/us")
 
 
-def load_bsh(filename, kind):
-    data = load_geojson(filename)
+def load_bsh(filename, kind, cache=None):
+    data = load_geojson(filename, cache=cache)
 
     # g = group_by(data, lambda e: e["id"].split(".")[0].split("_")[-1])
     # print(sorted(g.keys()))
@@ -350,8 +503,8 @@ def load_bsh(filename, kind):
 # load_bsh("data/bsh/AidsAndServices.json", "equi")
 
 
-def load_bsh_lights(filename):
-    data = load_geojson(filename)
+def load_bsh_lights(filename, cache=None):
+    data = load_geojson(filename, cache=cache)
 
     kind = "light"
     print("kind", kind)
@@ -398,15 +551,16 @@ def load_bsh_lights(filename):
 # load_bsh_lights("data/bsh/AidsAndServices.json")
 
 
-def load_bsh_obstr(filename, kind):
-    data = load_geojson(filename)
+def load_bsh_obstr(filename, kind, cache=None):
+    data = load_geojson(filename, cache=cache)
     points = []
     typ = {"r": "rock", "w": "wreck", "o": "obstruction"}[kind[0]]
     for f in data:
         if kind in f["id"].lower():
             ll = latlon(f)
             tags = {"ll": ll}
-            f["properties"]["_type_"] = typ
+            # copy, features may be shared with other layers through the cache
+            f = dict(f, properties=dict(f["properties"], _type_=typ))
             add_tags(tags, f)
             fix_tags(tags)
             assert smtype(tags) == typ, (f, tags)
@@ -422,9 +576,9 @@ def load_bsh_obstr(filename, kind):
 # load_bsh_obstr("data/bsh/RocksWrecksObstructions.json", "obstr")
 
 
-def load_bsh_seabed(filename):
+def load_bsh_seabed(filename, cache=None):
     # https://wiki.openstreetmap.org/wiki/Tag:seamark:type%3Dobstruction
-    data = load_geojson(filename)
+    data = load_geojson(filename, cache=cache)
     points = []
     kind = "seabed"
     for f in data:
@@ -615,45 +769,75 @@ deprecated_tags = (
 )
 
 
-def update_node(n, tags, dmin=1):
-    ll = [float(n.attr[a]) for a in ("lat", "lon")]
+class Node:
+    "OSM node element with its tags parsed into a dict once"
+
+    __slots__ = ("e", "tags", "_tags")
+
+    def __init__(self, e):
+        self.e = e
+        self._tags = {}
+        for t in e.iterchildren("tag"):
+            self._tags.setdefault(t.get("k"), t)
+        self.tags = {k: t.get("v") for k, t in self._tags.items()}
+
+    def attr(self, a):
+        return self.e.get(a)
+
+    def commit(self):
+        "write modified tags back to the element"
+        for k, t in self._tags.items():
+            v = self.tags.get(k)
+            if v is None:
+                self.e.remove(t)
+            elif t.get("v") != v:
+                t.set("v", v)
+        for k, v in self.tags.items():
+            if k not in self._tags:
+                etree.SubElement(self.e, "tag", k=k, v=v)
+        self._tags = {t.get("k"): t for t in self.e.iterchildren("tag")}
+
+
+def update_node(n, tags, dmin=1, d=None):
+    ll = [float(n.attr(a)) for a in ("lat", "lon")]
     modifications = []
 
-    d = distance(ll, tags["ll"])
+    if d is None:
+        d = distance(ll, tags["ll"])
     if isnan(d) or d > dmin:
-        n.attr["lat"], n.attr["lon"] = [str(x) for x in tags["ll"]]
+        lat, lon = [str(x) for x in tags["ll"]]
+        n.e.set("lat", lat)
+        n.e.set("lon", lon)
         modifications.append(("POS", tags["ll"], 0 if isnan(d) else round(d)))
 
-    fill_types(tags)
-
-    for k, v in tags.items():
+    t = n.tags
+    stale = {k: None for k in sorted(clear_keys(tags).intersection(t)) if k not in tags}
+    for k, v in chain(tags.items(), stale.items()):
         v = str(v) if v is not None else v
         if k.startswith("seamark") or k.startswith("depth"):
-            tag = n.find(f"tag[k='{k}']")
-            if tag:
-                w = tag.attr["v"]
+            w = t.get(k)
+            if w is not None:
                 if not v:
-                    tag.remove()
+                    del t[k]
                     modifications.append(("DEL", f"{k}={w}"))
                 elif (not str_equals(w, v)) if k == "seamark:name" else w != v:
-                    tag.attr["v"] = v
+                    t[k] = v
                     modifications.append(("MOD", f"{k}={v}", w))
             elif v:
-                pq(f'<tag k="{k}" v="{v}" />').append_to(n)
+                t[k] = v
                 modifications.append(("ADD", f"{k}={v}"))
 
     if modifications:
-        n.attr["action"] = "modify"
+        n.e.set("action", "modify")
         for k in deprecated_tags:
-            tag = n.find(f"tag[k='{k}']")
-            if tag:
+            if k in t:
                 if k == "seamark:source":
-                    if not tag.attr["v"].endswith("*"):
-                        tag.attr["v"] += " *"
+                    if not t[k].endswith("*"):
+                        t[k] += " *"
                 else:
-                    tag.remove()
+                    del t[k]
 
-        ll = [float(n.attr[a]) for a in ("lat", "lon")]
+        ll = [float(n.attr(a)) for a in ("lat", "lon")]
         msg = (
             tags.get("seamark:type"),
             tags.get("seamark:name"),
@@ -662,10 +846,11 @@ def update_node(n, tags, dmin=1):
             n.attr("timestamp"),
             n.attr("user"),
         )
-        modifications.insert(0, josm_zoom(ll, n.attr["id"]))
+        modifications.insert(0, josm_zoom(ll, n.attr("id")))
         modifications.insert(0, msg)
         # for l in modifications:            print("\t", *[str(s).strip() for s in l])
 
+    n.commit()
     return modifications
 
 
@@ -674,6 +859,62 @@ def str_equals(a, b):
     return a == b
 
 
+def source_key(tags):
+    "identity of a source point: lnam or position"
+    return tags.get("seamark:lnam") or "{:.7f},{:.7f}".format(*tags["ll"])
+
+
+def tags_hash(tags):
+    t = {k: v for k, v in tags.items() if k != "match" and v is not None}
+    return sha1(json.dumps(t, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class MatchCache:
+    "sqlite file of OSM nodes that are in sync with their source point"
+
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS matches"
+            " (node TEXT PRIMARY KEY, version TEXT, source TEXT, hash TEXT)"
+        )
+
+    def get(self, node):
+        "(version, source key, tags hash) of node or None"
+        return self.db.execute(
+            "SELECT version, source, hash FROM matches WHERE node=?", (node,)
+        ).fetchone()
+
+    def put(self, node, version, tags):
+        self.db.execute(
+            "REPLACE INTO matches VALUES (?, ?, ?, ?)",
+            (node, version, source_key(tags), tags_hash(tags)),
+        )
+
+    def drop(self, node):
+        self.db.execute("DELETE FROM matches WHERE node=?", (node,))
+
+    def close(self, commit=True):
+        "store the changes of this run, or discard them (commit=False)"
+        if commit:
+            self.db.commit()
+        else:
+            self.db.rollback()
+        self.db.close()
+
+
+def write_osc(filename, changes):
+    "write created/modified/deleted elements as osmChange file"
+    osc = etree.Element("osmChange", version="0.6", generator="update.py")
+    for action, elements in changes.items():
+        if elements:
+            etree.SubElement(osc, action).extend(elements)
+    etree.indent(osc, space="  ")
+    s = etree.tostring(osc, pretty_print=True, xml_declaration=True, encoding="utf-8")
+    with open(filename, "wb") as f:
+        f.write(s)
+
+
 def update_osm(
     infile,
     points,
@@ -688,14 +929,20 @@ def update_osm(
     min_age=0,
     user=None,
     review=False,
+    stream=False,
+    cache=None,
 ):
     infile = infile if infile != "none" else None
-    x = pq(filename=infile) if infile else pq("<osm version='0.6'/>")
     add |= not infile
+    stream &= bool(infile)
+    if stream:
+        bounds = get_bounds_stream(infile)
+    else:
+        x = pq(filename=infile) if infile else pq("<osm version='0.6'/>")
+        bounds = get_bounds(x)
 
     now = pendulum.now()
 
-    bounds = get_bounds(x)
     print("bounds", bounds)
     data = (
         list(
@@ -709,58 +956,79 @@ def update_osm(
         else points
     )
     print("points", len(data))
+    index = PointIndex(data, cell=max(p_dist, n_dist / 4, 1))
+
+    if cache:
+        cache = MatchCache(cache)
+        sources = group_by(data, source_key, indices=True)
 
     matches = {}
     modifications = []
-    for e in track(list(x("node")), "updating nodes"):
-        n = pq(e)
-        if not n.find("tag[k='seamark:type']"):
-            continue
-        if re.match(sm_type, n.find("tag[k='seamark:type']").attr["v"]) is None:
-            continue
-        ll = [float(n.attr[a]) for a in ("lat", "lon")]
+    osc = outfile.endswith(".osc")
+    changes = {"create": [], "modify": [], "delete": []}
+
+    def changed(action, e):
+        if osc:
+            e = deepcopy(e)
+            e.attrib.pop("action", None)
+            changes[action].append(e)
+
+    def update(e):
+        n = Node(e)
+        type = n.tags.get("seamark:type")
+        if not type:
+            return
+        if re.match(sm_type, type) is None:
+            return
+        ll = [float(n.attr(a)) for a in ("lat", "lon")]
         if bounds and not (
             bounds["minlat"] <= ll[0] <= bounds["maxlat"]
             and bounds["minlon"] <= ll[1] <= bounds["maxlon"]
         ):
-            continue
+            return
+        xy = latlon_to_grid(*ll)
         ts = n.attr("timestamp")
         age = None
         if ts:
             ts = pendulum.parse(ts)
             age = now - ts
 
-        type = n.find("tag[k='seamark:type']").attr["v"]
-        name = (
-            n.find("tag[k='seamark:name']").attr["v"]
-            or n.find("tag[k='name']").attr["v"]
-        )
-        lnam = n.find("tag[k='seamark:lnam']").attr["v"]
-
-        p = []
+        name = n.tags.get("seamark:name") or n.tags.get("name")
+        lnam = n.tags.get("seamark:lnam")
+
+        # skip nodes that were in sync with an unchanged source point last time,
+        # nodes without version (new or edited) can't be compared
+        version = n.attr("version")
+        c = cache and version and not n.attr("action") and cache.get(n.attr("id"))
+        if c and c[0] == version:
+            ids = [i for i in sources.get(c[1], []) if not index.consumed[i]]
+            if len(ids) == 1 and tags_hash(data[ids[0]]) == c[2]:
+                index.consume(ids[0])
+                matches["CACHED"] = matches.get("CACHED", 0) + 1
+                return
+
+        ids = []
         match = "NONE"
 
         if lnam:
-            p = list(filter(lambda e: lnam == e.get("seamark:lnam"), data))
-            if p:
+            ids = index.lnam(lnam)
+            if ids:
                 match = "LNAM"
 
-        if not p and name:
-            p = list(
-                filter(
-                    lambda e: distance(ll, e["ll"]) <= n_dist
-                    and str_equals(name, e.get("seamark:name")),
-                    data,
-                )
+        if not ids and name:
+            ids = index.near(
+                xy, n_dist, lambda e: str_equals(name, e.get("seamark:name"))
             )
-            if p:
+            if ids:
                 match = "NAME"
 
-        if not p:
-            p = list(filter(lambda e: distance(ll, e["ll"]) <= p_dist, data))
-            if p:
+        if not ids:
+            ids = index.near(xy, p_dist)
+            if ids:
                 match = "POSI"
 
+        p = [data[i] for i in ids]
+
         matches[match] = matches.get(match, 0) + 1
 
         if len(p) > 1:
@@ -775,55 +1043,111 @@ def update_osm(
                 # json.dumps(p, indent=2),
             )
 
-        for m in p:
-            data.remove(m)
+        for i in ids:
+            index.consume(i)
 
-        if not n.attr["action"]:
+        if not n.attr("action"):
             if age and age.days < min_age:
                 print("[yellow]SKIPPED", type, name, ts)
-                continue
+                return
             if user and (
                 n.attr("user") == user[1:]
                 if user.startswith("-")
                 else n.attr("user") != user
             ):
                 print("[yellow]SKIPPED", type, name, n.attr("user"))
-                continue
+                return
 
         if remove and len(p) == 0:
-            m = ["REMOVE?", (type, name), josm_zoom(ll, n.attr["id"])]
+            m = ["REMOVE?", (type, name), josm_zoom(ll, n.attr("id"))]
             print(*m[:3])
             modifications.append(m)
+            changed("delete", e)
 
         if not add and len(p) == 1:
             p = p[0]
             p["match"] = match
-            if remod or not n.attr["action"]:
-                m = update_node(n, p, s_dist)
+            if remod or not n.attr("action"):
+                d = index.distance(ids[0], xy)
+                m = update_node(n, p, s_dist, d)
                 if m:
                     m.insert(0, "CHANGED")
                     # print(*m[:3])
                     modifications.append(m)
-
-    added = 0
-    if add:
+                    changed("modify", e)
+                if cache and version and not n.attr("action"):
+                    cache.put(n.attr("id"), version, p)
+                elif cache:
+                    cache.drop(n.attr("id"))
+
+    added = []
+
+    def add_points():
+        if not add:
+            return
+        data = index.remaining()
         for i, p in track(enumerate(data, 1), "adding points", total=len(data)):
-            n = pq(f'<node id="{-i}" visible="true" lat="nan" lon="nan"/>')
-            m = update_node(n, p, s_dist)
+            n = etree.Element("node", id=str(-i), visible="true", lat="nan", lon="nan")
+            m = update_node(Node(n), p, s_dist)
             m.insert(0, "ADDED")
             # print(*m[:3])
             modifications.append(m)
-            x("osm").append(n)
-            added += 1
+            changed("create", n)
+            added.append(n)
+            yield n
+
+    # the cache is only stored when all nodes were processed
+    try:
+        if stream and osc:
+            for e in track(iterparse_osm(infile), "updating nodes"):
+                if e.tag == "node":
+                    update(e)
+            list(add_points())
+        elif stream:
+            tmpfile = f"{outfile}.part"
+            with open(tmpfile, "wb") as f:
+                with etree.xmlfile(f, encoding="utf-8") as xf:
+                    with xf.element("osm", get_root(infile)):
+                        for e in track(iterparse_osm(infile), "updating nodes"):
+                            if e.tag == "node":
+                                update(e)
+                            e.tail = None
+                            etree.indent(e, space="  ", level=1)
+                            xf.write("\n  ", e)
+                        for n in add_points():
+                            etree.indent(n, space="  ", level=1)
+                            xf.write("\n  ", n)
+                        xf.write("\n")
+                f.write(b"\n")
+        else:
+            for e in track(list(x.root.iter("node")), "updating nodes"):
+                update(e)
+            for n in add_points():
+                x.root.getroot().append(n)
+    except:
+        if cache:
+            cache.close(commit=False)
+        raise
+    if cache:
+        cache.close()
 
     print("[yellow]MATCHED", matches)
-    print("[green]ADDED", added)
+    print("[green]ADDED", len(added))
+
+    if stream and not osc:
+        if modifications:
+            os.replace(tmpfile, outfile)
+        else:
+            os.remove(tmpfile)
 
     if modifications:
-        with open(outfile, "wb") as f:
-            etree.indent(x.root, space="  ")
-            s = etree.tostring(x.root, pretty_print=True, encoding="utf-8")
-            f.write(s)
+        if osc:
+            write_osc(outfile, changes)
+        elif not stream:
+            with open(outfile, "wb") as f:
+                etree.indent(x.root, space="  ")
+                s = etree.tostring(x.root, pretty_print=True, encoding="utf-8")
+                f.write(s)
 
         try:
             requests.get(
@@ -858,6 +1182,73 @@ def update_osm(
                 input(f"  {i}/{len(modifications)}")
 
 
+def load_data(mode, datafile, skip_errors=False, jobs=None, cache=None):
+    """load source data for mode, return seamark type (regex) and points
+
+    cache: dict shared between calls to load each BSH file only once"""
+    seamark_type = "xxx"
+    if all(s in mode for s in ("rws", "buoy")):
+        seamark_type = "buoy_.*"
+        data = load_rws_buoys(datafile, skip_errors)
+    if all(s in mode for s in ("rws", "beac")):
+        seamark_type = "beacon_.*"
+        data = load_rws_beacons(datafile, skip_errors)
+    elif all(s in mode for s in ("marre",)):
+        seamark_type = "buoy_.*"
+        data = load_marrekrite(datafile)
+    elif all(s in mode for s in ("bsh", "buoy")):
+        seamark_type = "buoy_.*"
+        data = load_bsh(datafile, "buoy", cache=cache)
+    elif all(s in mode for s in ("bsh", "beac")):
+        seamark_type = "beacon_.*"
+        data = load_bsh(datafile, "beacon", cache=cache)
+    elif all(s in mode for s in ("bsh", "rock")):
+        seamark_type = "rock"
+        data = load_bsh_obstr(datafile, seamark_type, cache=cache)
+    elif all(s in mode for s in ("bsh", "wreck")):
+        seamark_type = "wreck"
+        data = load_bsh_obstr(datafile, seamark_type, cache=cache)
+    elif all(s in mode for s in ("bsh", "obstr")):
+        seamark_type = "obstruction"
+        data = load_bsh_obstr(datafile, "obstr,foul", cache=cache)
+    elif all(s in mode for s in ("bsh", "seabed")):
+        seamark_type = "seabed_area|weed|seagrass"
+        data = load_bsh_seabed(datafile, cache=cache)
+    elif all(s in mode for s in ("bsh", "light")):
+        seamark_type = "light_.*|landmark"
+        data = load_bsh_lights(datafile, cache=cache)
+    elif all(s in mode for s in ("bsh", "fac")):
+        data = load_bsh(datafile, "facility", cache=cache)
+    elif all(s in mode for s in ("bsh", "feat")):
+        data = load_bsh(datafile, "feature", cache=cache)
+    elif all(s in mode for s in ("bsh", "serv")):
+        data = load_bsh(datafile, "service", cache=cache)
+    elif all(s in mode for s in ("bsh", "stat")):
+        data = load_bsh(datafile, "station", cache=cache)
+    elif all(s in mode for s in ("bsh", "equi")):
+        data = load_bsh(datafile, "equipment", cache=cache)
+
+    elif all(s in mode for s in ("enc", "rock")):
+        data = load_enc_layers(datafile, ["UWTROC", "WRECKS", "OBSTRN"], [], jobs)
+    elif all(s in mode for s in ("enc")):
+        data = load_enc_layers(datafile, jobs=jobs)
+
+    return seamark_type, data
+
+
+BSH_LAYERS = {  # layer: source file prefix
+    "buoys": "A",
+    "beacons": "A",
+    "facilities": "A",
+    "lights": "A",
+    "stations": "A",
+    "rocks": "R",
+    "wrecks": "R",
+    "obstructions": "R",
+    "seabed": "H",
+}
+
+
 def main():
     parser = ArgumentParser(
         description="update buoys by manipulating OSM xml from geojson",
@@ -867,7 +1258,7 @@ def main():
 
     parser.add_argument(
         "mode",
-        help="mode of operation (what kind of data to read and update)",
+        help="mode of operation (what kind of data to read and update), bsh-all: all BSH layers at once, source and output are directories",
     )
     parser.add_argument(
         "datafile",
@@ -882,7 +1273,7 @@ def main():
     )
     parser.add_argument(
         "outfile",
-        help="OSM XML file to write",
+        help="OSM XML file to write (.osc writes only the changes as osmChange)",
         default="out.osm",
         metavar="out.osm",
         nargs="?",
@@ -902,7 +1293,7 @@ def main():
     parser.add_argument(
         "-r",
         "--remove",
-        help="print hint for node to be removed (they are not removed automatically)",
+        help="print hint for node to be removed (not removed automatically, .osc lists them as delete)",
         action="store_true",
     )
     parser.add_argument(
@@ -944,6 +1335,22 @@ def main():
         "--user",
         help="user of previous change",
     )
+    parser.add_argument(
+        "-s",
+        "--stream",
+        help="stream the OSM file instead of loading it completely (flat memory)",
+        action="store_true",
+    )
+    parser.add_argument(
+        "-C",
+        "--cache",
+        help="sqlite file to remember nodes in sync with the source, they are skipped in later runs",
+    )
+    parser.add_argument(
+        "--jobs",
+        help="number of processes for loading ENC layers (default or 0: number of cores)",
+        type=int,
+    )
     parser.add_argument(
         "--skip-errors",
         action="store_true",
@@ -957,70 +1364,44 @@ def main():
     infile = args.infile
     outfile = args.outfile
 
-    seamark_type = "xxx"
-    if all(s in mode for s in ("rws", "buoy")):
-        seamark_type = "buoy_.*"
-        data = load_rws_buoys(datafile, args.skip_errors)
-    if all(s in mode for s in ("rws", "beac")):
-        seamark_type = "beacon_.*"
-        data = load_rws_beacons(datafile, args.skip_errors)
-    elif all(s in mode for s in ("marre",)):
-        seamark_type = "buoy_.*"
-        data = load_marrekrite(datafile)
-    elif all(s in mode for s in ("bsh", "buoy")):
-        seamark_type = "buoy_.*"
-        data = load_bsh(datafile, "buoy")
-    elif all(s in mode for s in ("bsh", "beac")):
-        seamark_type = "beacon_.*"
-        data = load_bsh(datafile, "beacon")
-    elif all(s in mode for s in ("bsh", "rock")):
-        seamark_type = "rock"
-        data = load_bsh_obstr(datafile, seamark_type)
-    elif all(s in mode for s in ("bsh", "wreck")):
-        seamark_type = "wreck"
-        data = load_bsh_obstr(datafile, seamark_type)
-    elif all(s in mode for s in ("bsh", "obstr")):
-        seamark_type = "obstruction"
-        data = load_bsh_obstr(datafile, "obstr,foul")
-    elif all(s in mode for s in ("bsh", "seabed")):
-        seamark_type = "seabed_area|weed|seagrass"
-        data = load_bsh_seabed(datafile)
-    elif all(s in mode for s in ("bsh", "light")):
-        seamark_type = "light_.*|landmark"
-        data = load_bsh_lights(datafile)
-    elif all(s in mode for s in ("bsh", "fac")):
-        data = load_bsh(datafile, "facility")
-    elif all(s in mode for s in ("bsh", "feat")):
-        data = load_bsh(datafile, "feature")
-    elif all(s in mode for s in ("bsh", "serv")):
-        data = load_bsh(datafile, "service")
-    elif all(s in mode for s in ("bsh", "stat")):
-        data = load_bsh(datafile, "station")
-    elif all(s in mode for s in ("bsh", "equi")):
-        data = load_bsh(datafile, "equipment")
+    def update(mode, datafile, outfile, cache=None):
+        seamark_type, data = load_data(
+            mode, datafile, args.skip_errors, args.jobs, cache
+        )
 
-    elif all(s in mode for s in ("enc", "rock")):
-        data = load_enc_layers(datafile, ["UWTROC", "WRECKS", "OBSTRN"], [])
-    elif all(s in mode for s in ("enc")):
-        data = load_enc_layers(datafile)
-
-    print("seamark:type", seamark_type)
-
-    update_osm(
-        infile,
-        data,
-        outfile,
-        add=args.add,
-        remod=args.remod,
-        remove=args.remove,
-        n_dist=args.n_dist,
-        p_dist=args.p_dist,
-        s_dist=args.s_dist,
-        sm_type=seamark_type,
-        min_age=args.age,
-        user=args.user,
-        review=args.review,
-    )
+        print("seamark:type", seamark_type)
+
+        update_osm(
+            infile,
+            data,
+            outfile,
+            add=args.add,
+            remod=args.remod,
+            remove=args.remove,
+            n_dist=args.n_dist,
+            p_dist=args.p_dist,
+            s_dist=args.s_dist,
+            sm_type=seamark_type,
+            min_age=args.age,
+            user=args.user,
+            review=args.review,
+            stream=args.stream,
+            cache=args.cache,
+        )
+
+    if all(s in mode for s in ("bsh", "all")):
+        # all layers in one run, source and output are directories
+        cache = {}
+        makedirs(outfile, exist_ok=True)
+        for layer, prefix in BSH_LAYERS.items():
+            sources = sorted(glob(f"{datafile}/{prefix}*.json"))
+            if not sources:
+                parser.error(f"no source {prefix}*.json for {layer} in {datafile}")
+            print(f"[blue]{layer}[/]", sources[0])
+            update(f"bsh-{layer}", sources[0], f"{outfile}/{layer}.osm", cache)
+        return
+
+    update(mode, datafile, outfile)
 
 
 if __name__ == "__main__":